@@ -0,0 +1,192 @@
+# Attention backends for StageC
+# Every backend takes q, k, v as [B, heads, tokens, head_dim] and returns the same layout, so the projections
+# (nn.MultiheadAttention's in_proj_weight/out_proj layout) and the checkpoints stay the same whichever one runs.
+
+import time
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+def sdpa_attention(q, k, v, dropout=0.0):
+    return nn.functional.scaled_dot_product_attention(q, k, v, dropout_p=dropout)
+
+def xformers_attention(q, k, v, dropout=0.0):
+    import xformers.ops
+    q, k, v = [t.transpose(1, 2).contiguous() for t in (q, k, v)]
+    out = xformers.ops.memory_efficient_attention(q, k, v, attn_bias=None, p=dropout)
+    return out.transpose(1, 2)
+
+def math_attention(q, k, v, dropout=0.0):
+    b, h, n, d = q.shape
+    q, k, v = q.reshape(b * h, n, d), k.reshape(b * h, -1, d), v.reshape(b * h, -1, d)
+    scores = torch.baddbmm(
+        torch.empty(q.shape[0], q.shape[1], k.shape[1], dtype=q.dtype, device=q.device),
+        q,
+        k.transpose(-1, -2),
+        beta=0,
+        alpha=d ** -0.5,
+    )
+    probs = scores.softmax(dim=-1).to(v.dtype)
+    if dropout > 0:
+        probs = nn.functional.dropout(probs, p=dropout)
+    return torch.bmm(probs, v).view(b, h, n, d)
+
+# Peak bytes the chunked backend may spend on score tiles, see set_attention_memory_budget
+attention_memory_budget = 256 * 1024 ** 2
+
+def set_attention_memory_budget(memory_budget):
+    global attention_memory_budget
+    attention_memory_budget = memory_budget
+
+def attention_chunk_sizes(batch_heads, n_queries, n_keys, memory_budget=None):
+    # Query and key tile sizes whose float32 score tiles (and the temporaries built from them) fit the budget
+    memory_budget = attention_memory_budget if memory_budget is None else memory_budget
+    elements = max(memory_budget // (4 * 3 * batch_heads), 1)
+    if elements // n_keys >= 16:
+        # Every key fits next to a reasonable query tile, a single key pass
+        return min(n_queries, elements // n_keys), n_keys
+    side = max(16, int(elements ** 0.5))
+    q_chunk = min(n_queries, side)
+    return q_chunk, min(n_keys, max(16, elements // q_chunk))
+
+def streaming_attention(q, k, v, dropout, k_chunk):
+    # Softmax over key tiles with a running max and sum (online softmax), accumulated in float32
+    scale = q.shape[-1] ** -0.5
+    q = q.float() * scale
+    row_max = torch.full((*q.shape[:-1], 1), float("-inf"), device=q.device)
+    row_sum = torch.zeros((*q.shape[:-1], 1), device=q.device)
+    acc = torch.zeros(q.shape, device=q.device)
+    for j in range(0, k.shape[2], k_chunk):
+        scores = q @ k[:, :, j:j + k_chunk].float().transpose(-1, -2)
+        new_max = torch.maximum(row_max, scores.amax(dim=-1, keepdim=True))
+        correction = (row_max - new_max).exp()
+        probs = (scores - new_max).exp()
+        del scores
+        row_sum = row_sum * correction + probs.sum(dim=-1, keepdim=True)
+        if dropout > 0:
+            probs = nn.functional.dropout(probs, p=dropout)
+        acc = acc * correction + probs @ v[:, :, j:j + k_chunk].float()
+        row_max = new_max
+    return (acc / row_sum).to(v.dtype)
+
+def chunked_attention(q, k, v, dropout=0.0, memory_budget=None):
+    # Tiles queries and keys so peak memory is bounded by the budget whatever the resolution.
+    # With autograd every query tile is recomputed in backward instead of keeping its tiles around.
+    b, h, n, d = q.shape
+    q_chunk, k_chunk = attention_chunk_sizes(b * h, n, k.shape[2], memory_budget)
+    use_checkpoint = torch.is_grad_enabled() and (q.requires_grad or k.requires_grad or v.requires_grad)
+    outputs = []
+    for i in range(0, n, q_chunk):
+        q_tile = q[:, :, i:i + q_chunk]
+        if use_checkpoint:
+            outputs.append(checkpoint(streaming_attention, q_tile, k, v, dropout, k_chunk, use_reentrant=False))
+        else:
+            outputs.append(streaming_attention(q_tile, k, v, dropout, k_chunk))
+    return outputs[0] if len(outputs) == 1 else torch.cat(outputs, dim=2)
+
+def xformers_available(device):
+    if device.type != "cuda":
+        return False
+    try:
+        import xformers.ops
+        return True
+    except ImportError:
+        return False
+
+attention_backends = {}
+
+def register_attention_backend(name, fn, available=None):
+    # available(device) -> bool, backends that can't run on a device are never selected for it
+    attention_backends[name] = (fn, available)
+
+register_attention_backend("sdpa", sdpa_attention)
+register_attention_backend("xformers", xformers_attention, xformers_available)
+register_attention_backend("math", math_attention)
+register_attention_backend("chunked", chunked_attention)
+
+def available_attention_backends(device):
+    return [name for name, (fn, available) in attention_backends.items() if available is None or available(device)]
+
+# (device type, dtype, q shape, key count) -> fastest backend name, filled by warm_up_attention_backends
+attention_choices = {}
+# Shapes "auto" had no choice for while warm_up_attention_backends runs the model, None outside of it
+attention_pending = None
+
+def attention_key(q, k):
+    return (q.device.type, q.dtype, tuple(q.shape), k.shape[2])
+
+def time_attention_backend(fn, q, k, v, iters, backward=False):
+    # With backward the chunked backend's recompute counts too, q, k and v are fresh leaves outside of any hooks
+    if backward:
+        q, k, v = [t.detach().requires_grad_(True) for t in (q, k, v)]
+
+    def run():
+        with torch.enable_grad() if backward else torch.no_grad():
+            out = fn(q, k, v)
+            if backward:
+                out.float().sum().backward()
+
+    run()
+    if q.device.type == "cuda":
+        torch.cuda.synchronize(q.device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        run()
+    if q.device.type == "cuda":
+        torch.cuda.synchronize(q.device)
+    return time.perf_counter() - start
+
+def select_attention_backend(key, head_dim, training=True, candidates=None, iters=3):
+    # Picks the fastest backend for one attention_key with a short microbenchmark on random inputs
+    if key not in attention_choices:
+        device_type, dtype, q_shape, n_keys = key
+        device = torch.device(device_type)
+        q = torch.randn(q_shape, device=device, dtype=dtype)
+        k = torch.randn(*q_shape[:2], n_keys, head_dim, device=device, dtype=dtype)
+        v = torch.randn_like(k)
+        candidates = available_attention_backends(device) if candidates is None else candidates
+        timings = {}
+        for name in candidates:
+            try:
+                timings[name] = time_attention_backend(attention_backends[name][0], q, k, v, iters, training)
+            except (RuntimeError, NotImplementedError):
+                # e.g. a kernel that doesn't support this dtype or head size
+                continue
+        # The math backend is plain matmuls and runs anywhere
+        attention_choices[key] = min(timings, key=timings.get) if len(timings) > 0 else "math"
+    return attention_choices[key]
+
+def warm_up_attention_backends(model, inputs, training=True, candidates=None, iters=3):
+    # Runs the model once per entry of inputs (keyword arguments of its forward) under no_grad to collect the attention
+    # shapes, then benchmarks every new one outside of the forward. Call before checkpointing, offloading and compiling,
+    # with the autocast the training step uses. Returns the choices made
+    global attention_pending
+    attention_pending = {}
+    try:
+        with torch.no_grad():
+            for model_inputs in inputs:
+                model(**model_inputs)
+        pending = attention_pending
+    finally:
+        attention_pending = None
+    return {key: select_attention_backend(key, head_dim, training, candidates, iters) for key, head_dim in pending.items()}
+
+def get_attention_backend(name, q, k, v):
+    if name == "auto":
+        # Only a lookup, shapes that were not warmed up run sdpa
+        key = attention_key(q, k)
+        name = attention_choices.get(key)
+        if name is None:
+            if attention_pending is not None:
+                attention_pending[key] = q.shape[-1]
+            name = "sdpa"
+    return attention_backends[name][0]
+
+def set_attention_backend(model, name):
+    # Switches every attention layer of a loaded model, no weights change
+    if name != "auto" and name != "mha" and name not in attention_backends:
+        raise ValueError(f"Unknown attention backend: {name}, expected one of {['mha', 'auto'] + list(attention_backends)}")
+    for module in model.modules():
+        if hasattr(module, "backend") and hasattr(module, "attn") and isinstance(module.attn, nn.MultiheadAttention):
+            module.backend = name
+    return model
@@ -0,0 +1,197 @@
+# Benchmarks for StageC sampling and training speed ups
+
+import time
+import copy
+import torch
+from model_util import StageC, DeepCachedStageC, stage_c_inputs
+from gdf_util import GDF, EpsilonTarget, CosineSchedule, VPScaler, CosineTNoiseCond, P2LossWeight, DDIMSampler, DPMSolverMultistepSampler, UniPCSampler
+
+def run_sample(gdf, model, model_inputs, x_init, sampler, timesteps, cfg=None, device="cpu", **kwargs):
+	x0 = None
+	for x0, x, pred in gdf.sample(model, model_inputs, x_init.shape, x_init=x_init, sampler=sampler, timesteps=timesteps, cfg=cfg, device=device, **kwargs):
+		pass
+	return x0
+
+def compare_samplers(
+	gdf,
+	model,
+	model_inputs,
+	shape,
+	samplers=None,
+	steps=[4, 8, 12, 16, 20],
+	reference_steps=200,
+	seed=0,
+	cfg=None,
+	device="cpu",
+	**kwargs
+):
+	# Error of every sampler at every step count against a many step DDIM solution of the same ODE from the same noise
+	samplers = {"ddim": DDIMSampler, "dpmpp_2m": DPMSolverMultistepSampler, "unipc": UniPCSampler} if samplers is None else samplers
+	generator = torch.Generator().manual_seed(seed)
+	x_init = torch.randn(*shape, generator=generator).to(device)
+
+	with torch.no_grad():
+		reference = run_sample(gdf, model, model_inputs, x_init, DDIMSampler(gdf), reference_steps, cfg=cfg, device=device, **kwargs)
+		results = []
+		for name, sampler_fn in samplers.items():
+			for timesteps in steps:
+				if torch.cuda.is_available():
+					torch.cuda.synchronize()
+				start = time.perf_counter()
+				x0 = run_sample(gdf, model, model_inputs, x_init, sampler_fn(gdf), timesteps, cfg=cfg, device=device, **kwargs)
+				if torch.cuda.is_available():
+					torch.cuda.synchronize()
+				elapsed = time.perf_counter() - start
+				mse = (x0.float() - reference.float()).pow(2).mean().item()
+				psnr = 10 * torch.log10(reference.float().pow(2).mean() / max(mse, 1e-12)).item()
+				results.append({"sampler": name, "steps": timesteps, "mse": mse, "psnr": psnr, "seconds": elapsed})
+	return results
+
+def print_results(results):
+	print(f"{'sampler':<12}{'steps':>6}{'mse':>12}{'psnr':>8}{'seconds':>10}")
+	for result in results:
+		print(f"{result['sampler']:<12}{result['steps']:>6}{result['mse']:>12.3e}{result['psnr']:>8.2f}{result['seconds']:>10.3f}")
+
+def synchronize():
+	if torch.cuda.is_available():
+		torch.cuda.synchronize()
+
+def benchmark_forward(fn, iters=10, warmup=2):
+	# Average seconds per call after warmup
+	with torch.no_grad():
+		for _ in range(warmup):
+			fn()
+		synchronize()
+		start = time.perf_counter()
+		for _ in range(iters):
+			fn()
+		synchronize()
+	return (time.perf_counter() - start) / iters
+
+def tiny_stage_c(**kwargs):
+	# A few million parameter StageC with the real block layout, for CPU checks
+	config = {
+		"c_cond": 64, "c_hidden": [64, 64], "nhead": [2, 2], "blocks": [[1, 2], [2, 1]],
+		"c_clip_text": 32, "c_clip_text_pooled": 32, "c_clip_img": 16, "dropout": [0, 0]
+	}
+	return StageC(**(config | kwargs)).eval()
+
+# Keyword arguments of the released StageC sizes, as built by train_stage_c
+stage_c_configs = {
+	"3.6B": {},
+	"1B": {"c_cond": 1536, "c_hidden": [1536, 1536], "nhead": [24, 24], "blocks": [[4, 12], [12, 4]]}
+}
+
+def compare_channels_last(model, inputs, iters=10):
+	# Output difference and speed of the channels last mode against the default layout
+	reference = copy.deepcopy(model).set_channels_last(False)
+	channels_last = copy.deepcopy(model).set_channels_last(True)
+	with torch.no_grad():
+		diff = (reference(**inputs) - channels_last(**inputs)).abs().max().item()
+	return {
+		"max_abs_diff": diff,
+		"default_seconds": benchmark_forward(lambda: reference(**inputs), iters),
+		"channels_last_seconds": benchmark_forward(lambda: channels_last(**inputs), iters)
+	}
+
+def compare_token_merging(model, inputs, ratios=[[0.25, 0.0], [0.5, 0.0], [0.5, 0.25], [0.75, 0.5]], iters=10):
+	# Speed of every per level merge ratio against plain attention, with the output error relative to the plain output
+	model.set_token_merging(0.0)
+	with torch.no_grad():
+		reference = model(**inputs).float()
+	results = [{"ratios": [0.0] * len(model.down_blocks), "seconds": benchmark_forward(lambda: model(**inputs), iters), "relative_error": 0.0}]
+	for level_ratios in ratios:
+		model.set_token_merging(level_ratios)
+		with torch.no_grad():
+			output = model(**inputs).float()
+		results.append({
+			"ratios": level_ratios,
+			"seconds": benchmark_forward(lambda: model(**inputs), iters),
+			"relative_error": ((output - reference).norm() / reference.norm()).item()
+		})
+	model.set_token_merging(0.0)
+	for result in results:
+		result["speedup"] = results[0]["seconds"] / max(result["seconds"], 1e-9)
+	return results
+
+def print_token_merging(results):
+	print(f"{'ratios':<16}{'seconds':>10}{'speedup':>9}{'rel error':>11}")
+	for result in results:
+		print(f"{str(result['ratios']):<16}{result['seconds']:>10.4f}{result['speedup']:>9.2f}{result['relative_error']:>11.4f}")
+
+def compare_deep_cache(gdf, model, prompt_inputs, shape, intervals=[2, 3, 5], timesteps=20, seed=0, cfg=4.0, device="cpu", **kwargs):
+	# Sampling time and error of deep feature caching against full computation, over a fixed set of conditionings
+	# (one model_inputs dict per prompt) sampled from the same noise
+	generator = torch.Generator().manual_seed(seed)
+	x_init = torch.randn(*shape, generator=generator).to(device)
+	results = []
+	with torch.no_grad():
+		for interval in [1] + intervals:
+			sample_model = model if interval == 1 else DeepCachedStageC(model, interval)
+			outputs = []
+			synchronize()
+			start = time.perf_counter()
+			for model_inputs in prompt_inputs:
+				outputs.append(run_sample(gdf, sample_model, model_inputs, x_init, DDIMSampler(gdf), timesteps, cfg=cfg, device=device, **kwargs))
+				if interval > 1:
+					sample_model.reset()
+			synchronize()
+			results.append({"interval": interval, "seconds": time.perf_counter() - start, "outputs": outputs})
+	reference = results[0]["outputs"]
+	for result in results:
+		mse = sum((x0.float() - ref.float()).pow(2).mean().item() for x0, ref in zip(result.pop("outputs"), reference)) / len(reference)
+		result["mse"] = mse
+		result["psnr"] = 10 * torch.log10(torch.stack([ref.float().pow(2).mean() for ref in reference]).mean() / max(mse, 1e-12)).item()
+		result["speedup"] = results[0]["seconds"] / max(result["seconds"], 1e-9)
+	return results
+
+def print_deep_cache(results):
+	print(f"{'interval':>8}{'seconds':>10}{'speedup':>9}{'mse':>12}{'psnr':>8}")
+	for result in results:
+		print(f"{result['interval']:>8}{result['seconds']:>10.3f}{result['speedup']:>9.2f}{result['mse']:>12.3e}{result['psnr']:>8.2f}")
+
+def stage_c_prompt_inputs(model, n_prompts=4, n_chunks=1, seed=0, device="cpu", dtype=torch.float32):
+	# Fixed stand-in conditionings for when no text encoder is around, one per prompt
+	torch.manual_seed(seed)
+	prompt_inputs = []
+	for _ in range(n_prompts):
+		inputs = stage_c_inputs(model, 1, n_chunks=n_chunks, device=device, dtype=dtype)
+		prompt_inputs.append({k: v for k, v in inputs.items() if k.startswith("clip")})
+	return prompt_inputs
+
+class GaussianDenoiser():
+	# Exact epsilon prediction for x0 ~ N(mean, std^2), stands in for StageC when no checkpoint is around
+	def __init__(self, gdf, mean=0.5, std=0.5):
+		self.gdf = gdf
+		self.mean = mean
+		self.std = std
+
+	def __call__(self, x, r, **kwargs):
+		a, b = self.gdf.input_scaler(self.gdf.schedule(r))
+		a, b = a.view(-1, *[1]*(len(x.shape)-1)), b.view(-1, *[1]*(len(x.shape)-1))
+		return b * (x - a * self.mean) / (a ** 2 * self.std ** 2 + b ** 2)
+
+if __name__ == "__main__":
+	gdf = GDF(
+		schedule=CosineSchedule(clamp_range=[0.0001, 0.9999]),
+		input_scaler=VPScaler(), target=EpsilonTarget(),
+		noise_cond=CosineTNoiseCond(),
+		loss_weight=P2LossWeight(),
+	)
+	print_results(compare_samplers(gdf, GaussianDenoiser(gdf), {}, (4, 16, 24, 24)))
+	model = tiny_stage_c()
+	print(compare_channels_last(model, stage_c_inputs(model)))
+	print_token_merging(compare_token_merging(model, stage_c_inputs(model)))
+	print_deep_cache(compare_deep_cache(gdf, model, stage_c_prompt_inputs(model), (1, 16, 24, 24)))
+	if torch.cuda.is_available():
+		# Token merging on the released sizes at 1024x1024 (32x32 latents at the bucketer's compression of 32),
+		# pass trained weights through load_state_dict for a meaningful error
+		for name, config in stage_c_configs.items():
+			model = StageC(**config).eval().to("cuda", dtype=torch.bfloat16)
+			print(f"StageC {name}")
+			print_token_merging(compare_token_merging(model, stage_c_inputs(model, shape=(16, 32, 32), device="cuda", dtype=torch.bfloat16)))
+			prompt_inputs = stage_c_prompt_inputs(model, device="cuda", dtype=torch.bfloat16)
+			with torch.autocast("cuda", dtype=torch.bfloat16):
+				print_deep_cache(compare_deep_cache(gdf, model, prompt_inputs, (1, 16, 32, 32), device="cuda"))
+			del model
+			torch.cuda.empty_cache()
@@ -0,0 +1,254 @@
+# Latent cache helpers for Stable Cascade training
+
+import os
+import threading
+import torch
+from tqdm import tqdm
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+def map_tensors(value, fn):
+	if isinstance(value, torch.Tensor):
+		return fn(value)
+	elif isinstance(value, dict):
+		return {k: map_tensors(v, fn) for k, v in value.items()}
+	elif isinstance(value, list):
+		return [map_tensors(v, fn) for v in value]
+	elif isinstance(value, tuple):
+		return tuple(map_tensors(v, fn) for v in value)
+	return value
+
+class PinnedBufferPool():
+	# Reusable page locked host buffers, a buffer is only handed out again once its device copy has finished
+	def __init__(self):
+		self.free = {}
+		self.lock = threading.Lock()
+
+	def acquire(self, tensor, copy=True):
+		# A buffer laid out like tensor, filled with it unless copy is False (e.g. to copy into it asynchronously)
+		key = (tuple(tensor.shape), tuple(tensor.stride()), tensor.dtype)
+		buffer = None
+		event = None
+		with self.lock:
+			if key in self.free and len(self.free[key]) > 0:
+				buffer, event = self.free[key].pop()
+		if buffer is None:
+			buffer = torch.empty_like(tensor, device="cpu", pin_memory=True)
+		elif event is not None:
+			event.synchronize()
+		if copy:
+			buffer.copy_(tensor)
+		return buffer
+
+	def release(self, buffer, event):
+		key = (tuple(buffer.shape), tuple(buffer.stride()), buffer.dtype)
+		with self.lock:
+			if key not in self.free:
+				self.free[key] = []
+			self.free[key].append((buffer, event))
+
+class LatentCacheReader():
+	def __init__(
+		self,
+		entries,
+		device,
+		readahead=4,
+		num_workers=2,
+		sampler=None,
+		text_store=None
+	):
+		# entries: [{"path": ...}], read in sampler order (or list order) with a thread pool
+		# With a TextEmbeddingStore the workers also load the embeddings of entries that only keep text_keys
+		self.entries = entries
+		self.device = torch.device(device)
+		self.readahead = max(1, readahead)
+		self.num_workers = max(1, num_workers)
+		self.sampler = sampler
+		self.text_store = text_store
+		self.use_cuda = self.device.type == "cuda"
+		self.buffers = PinnedBufferPool() if self.use_cuda else None
+
+	def __len__(self):
+		return len(self.entries) if self.sampler is None else len(self.sampler)
+
+	def read(self, entry):
+		cache = torch.load(entry["path"], map_location="cpu")
+		if self.text_store is not None and "text_keys" in cache:
+			cache["text_embeddings"], cache["text_embeddings_pool"] = self.text_store.load(cache["text_keys"])
+		if self.use_cuda:
+			cache = map_tensors(cache, self.buffers.acquire)
+		return cache
+
+	def to_device(self, cache, stream):
+		pinned = []
+
+		def copy(tensor):
+			pinned.append(tensor)
+			return tensor.to(self.device, non_blocking=True)
+
+		with torch.cuda.stream(stream):
+			batch = map_tensors(cache, copy)
+			event = torch.cuda.Event()
+			event.record(stream)
+		for buffer in pinned:
+			self.buffers.release(buffer, event)
+		return batch, event
+
+	def __iter__(self):
+		order = range(len(self.entries)) if self.sampler is None else iter(self.sampler)
+		order = iter(order)
+		stream = torch.cuda.Stream(device=self.device) if self.use_cuda else None
+
+		with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+			futures = deque()
+
+			def submit():
+				idx = next(order, None)
+				if idx is not None:
+					futures.append(pool.submit(self.read, self.entries[idx]))
+
+			for _ in range(self.readahead):
+				submit()
+
+			pending = None
+			while len(futures) > 0:
+				cache = futures.popleft().result()
+				submit()
+				if not self.use_cuda:
+					yield cache
+					continue
+
+				# Start the copy of the next batch before handing out the current one
+				batch, event = self.to_device(cache, stream)
+				if pending is not None:
+					yield self.wait(*pending)
+				pending = (batch, event)
+
+			if pending is not None:
+				yield self.wait(*pending)
+
+	def wait(self, batch, event):
+		current = torch.cuda.current_stream(self.device)
+		current.wait_event(event)
+		# Tensors were allocated on the copy stream, let the allocator know they're used on the compute stream
+		map_tensors(batch, lambda tensor: tensor.record_stream(current))
+		return batch
+
+class LatentCacheWriter():
+	# Saves latent cache entries on a background thread so encoding never waits on the disk
+	def __init__(self, path, prefix="latent_cache", exclude=["images"]):
+		self.path = path
+		self.prefix = prefix
+		self.exclude = exclude
+		self.entries = []
+		self.futures = []
+		self.pool = ThreadPoolExecutor(max_workers=1)
+		os.makedirs(self.path, exist_ok=True)
+
+	def write(self, batch):
+		cache = {k: v for k, v in batch.items() if k not in self.exclude}
+		cache = map_tensors(cache, lambda tensor: tensor.detach().to("cpu"))
+		path = os.path.join(self.path, f"{self.prefix}_{len(self.entries)}.pt")
+		self.futures = [future for future in self.futures if not future.done()]
+		self.futures.append(self.pool.submit(torch.save, cache, path))
+		self.entries.append({"path": path})
+		return path
+
+	def close(self):
+		for future in self.futures:
+			future.result()
+		self.pool.shutdown()
+		return self.entries
+
+	def __len__(self):
+		return len(self.entries)
+
+def probe_batch_size(fn, make_batch, start=1, limit=64):
+	# Doubles the batch size until fn runs out of memory, returns the largest size that ran
+	best = None
+	size = start
+	while size <= limit:
+		try:
+			fn(make_batch(size))
+			best = size
+			size *= 2
+		except torch.cuda.OutOfMemoryError:
+			break
+		finally:
+			if torch.cuda.is_available():
+				torch.cuda.empty_cache()
+	return best if best is not None else start
+
+class LatentCacheBuilder():
+	def __init__(
+		self,
+		load_fn,
+		encode_fn,
+		writer,
+		encode_batch_size=None,
+		max_encode_batch_size=64,
+		text_store=None
+	):
+		# load_fn(batch) -> CPU images of one training batch
+		# encode_fn(images) -> {"effnet_cache": ..., "clip_cache": ...} for a batch of images of the same shape
+		# Encoding doesn't need to follow the training batch size, batches of the same shape are encoded together
+		# and split back into one cache entry per training batch.
+		self.load_fn = load_fn
+		self.encode_fn = encode_fn
+		self.writer = writer
+		self.encode_batch_size = encode_batch_size
+		self.max_encode_batch_size = max_encode_batch_size
+		self.text_store = text_store
+		self.pending = {}
+
+	def encode(self, images):
+		with torch.inference_mode():
+			return self.encode_fn(images)
+
+	def flush(self, shape):
+		group = self.pending.pop(shape)
+		images = torch.cat([batch_images for _, batch_images in group])
+
+		outputs = {}
+		for i in range(0, images.shape[0], self.encode_batch_size):
+			for name, value in self.encode(images[i:i + self.encode_batch_size]).items():
+				if name not in outputs:
+					outputs[name] = []
+				outputs[name].append(value)
+		outputs = {name: torch.cat(values) for name, values in outputs.items()}
+
+		offset = 0
+		for batch, batch_images in group:
+			size = batch_images.shape[0]
+			entry = {k: v for k, v in batch.items() if k != "images"}
+			for name, value in outputs.items():
+				# torch.save writes a view's whole storage, every file gets its own copy of just its samples
+				entry[name] = value[offset:offset + size].clone()
+			self.writer.write(entry)
+			offset += size
+
+	def build(self, batches):
+		for batch in tqdm(batches, desc="Latent Caching"):
+			images = self.load_fn(batch)
+			if self.encode_batch_size is None:
+				self.encode_batch_size = probe_batch_size(
+					self.encode,
+					lambda size: images[:1].repeat(size, *[1] * (images.dim() - 1)),
+					start=images.shape[0],
+					limit=max(images.shape[0], self.max_encode_batch_size)
+				)
+				tqdm.write(f"Latent cache encode batch size: {self.encode_batch_size}")
+
+			if self.text_store is not None:
+				batch["text_keys"] = self.text_store.encode(batch["raw_tokens"])
+
+			shape = tuple(images.shape[1:])
+			if shape not in self.pending:
+				self.pending[shape] = []
+			self.pending[shape].append((batch, images))
+			if sum(batch_images.shape[0] for _, batch_images in self.pending[shape]) >= self.encode_batch_size:
+				self.flush(shape)
+
+		for shape in list(self.pending.keys()):
+			self.flush(shape)
+		return self.writer.close()
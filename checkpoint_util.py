@@ -0,0 +1,247 @@
+# Activation checkpointing policies and activation offloading for StageC training
+# The auto-tuner measures one training step on the largest bucket for each candidate policy and keeps the one that
+# recomputes the fewest blocks while fitting the memory budget.
+# Offloading moves what the blocks of chosen levels save for backward (for checkpointed blocks only their inputs)
+# to pinned host memory on a side stream, and copies it back ahead of the backward pass.
+
+import time
+import weakref
+import torch
+from contextlib import nullcontext
+from cache_util import PinnedBufferPool
+from model_util import CheckpointPolicy, apply_checkpoint_policy, stage_c_inputs, run_step
+
+def checkpoint_candidates(n_levels):
+	# Candidate policies from the cheapest to the most recompute, TimestepBlocks only as the last resort
+	candidates = [CheckpointPolicy(block_types=[])]
+	for block_types in [["AttnBlock"], ["ResBlock", "AttnBlock"]]:
+		for levels in [[level] for level in range(n_levels)] + [None]:
+			for every in [4, 2, 1]:
+				candidates.append(CheckpointPolicy(block_types, levels=levels, every=every))
+	candidates.append(CheckpointPolicy(["ResBlock", "AttnBlock", "TimestepBlock"]))
+	return candidates
+
+def step_memory(model, inputs, autocast):
+	# Peak bytes a forward and backward allocate on top of what is already resident, None if it ran out of memory
+	device = inputs["x"].device
+	model.zero_grad(set_to_none=True)
+	torch.cuda.empty_cache()
+	torch.cuda.reset_peak_memory_stats(device)
+	start = torch.cuda.memory_allocated(device)
+	try:
+		run_step(model, inputs, True, autocast)
+		return torch.cuda.max_memory_allocated(device) - start
+	except torch.cuda.OutOfMemoryError:
+		return None
+	finally:
+		model.zero_grad(set_to_none=True)
+		torch.cuda.empty_cache()
+
+def largest_shape(latent_shapes):
+	return max(latent_shapes, key=lambda shape: shape[1] * shape[2])
+
+def tune_checkpointing(
+	model,
+	latent_shapes,
+	memory_budget,
+	batch_size=1,
+	n_chunks=1,
+	device="cuda",
+	dtype=torch.float32,
+	autocast_dtype=None,
+	candidates=None
+):
+	# memory_budget: bytes one training step may allocate for activations and gradients on top of the resident model.
+	# Applies and returns the policy with the fewest checkpointed blocks that fits, and the measurements per candidate
+	device = torch.device(device)
+	candidates = checkpoint_candidates(len(model.down_blocks)) if candidates is None else candidates
+	# Fewer checkpointed blocks means less recompute, identical selections are only measured once
+	by_count = {}
+	for policy in candidates:
+		selected = tuple(id(module) for module in policy.select(model))
+		by_count.setdefault(selected, policy)
+	ordered = sorted(by_count.items(), key=lambda item: len(item[0]))
+
+	autocast = (lambda: torch.autocast(device.type, dtype=autocast_dtype)) if autocast_dtype is not None else nullcontext
+	inputs = stage_c_inputs(model, batch_size, largest_shape(latent_shapes), n_chunks, device=device, dtype=dtype)
+	training = model.training
+	model.train()
+	report = []
+	chosen = ordered[-1][1]
+	for selected, policy in ordered:
+		apply_checkpoint_policy(model, policy, device)
+		memory = step_memory(model, inputs, autocast)
+		report.append({"policy": policy, "blocks": len(selected), "memory": memory})
+		if memory is not None and memory <= memory_budget:
+			chosen = policy
+			break
+	apply_checkpoint_policy(model, chosen, device)
+	model.train(training)
+	return chosen, report
+
+class OffloadedTensor():
+	def __init__(self, buffer, index):
+		self.buffer = buffer
+		self.index = index
+		self.uses = 1
+		self.device_tensor = None
+		self.ready = None
+
+class ActivationOffloader():
+	# pack/unpack hooks for torch.autograd.graph.saved_tensors_hooks. Saved tensors of at least min_bytes go to pinned
+	# host memory while the forward continues, unpacking one starts copying back the next `prefetch` ones backward needs
+	def __init__(self, device, prefetch=2, min_bytes=1024 ** 2):
+		self.device = torch.device(device)
+		self.prefetch = prefetch
+		self.min_bytes = min_bytes
+		self.stream = torch.cuda.Stream(self.device)
+		self.buffers = PinnedBufferPool()
+		self.order = []
+		self.packed = {}
+		self.offloaded_bytes = 0
+
+	def pack(self, tensor):
+		if tensor.device.type != "cuda" or tensor.numel() * tensor.element_size() < self.min_bytes:
+			return tensor
+		# Conditioning and the timestep embedding are saved by every block, they are only copied once
+		key = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape), tuple(tensor.stride()), tensor._version)
+		if key in self.packed:
+			ref, handle = self.packed[key]
+			if ref() is tensor:
+				handle.uses += 1
+				return handle
+		# Pinned buffers are reused across steps once their copy back has finished
+		handle = OffloadedTensor(self.buffers.acquire(tensor, copy=False), len(self.order))
+		self.stream.wait_stream(torch.cuda.current_stream(self.device))
+		with torch.cuda.stream(self.stream):
+			handle.buffer.copy_(tensor, non_blocking=True)
+		# The allocator must not hand the device memory out again before the copy has read it
+		tensor.record_stream(self.stream)
+		self.packed[key] = (weakref.ref(tensor), handle)
+		self.order.append(handle)
+		self.offloaded_bytes += tensor.numel() * tensor.element_size()
+		return handle
+
+	def fetch(self, handle):
+		with torch.cuda.stream(self.stream):
+			handle.device_tensor = torch.empty_like(handle.buffer, device=self.device)
+			handle.device_tensor.copy_(handle.buffer, non_blocking=True)
+			handle.ready = torch.cuda.Event()
+			handle.ready.record(self.stream)
+
+	def unpack(self, handle):
+		if not isinstance(handle, OffloadedTensor):
+			return handle
+		# Backward runs in reverse, the tensors packed just before this one are needed next
+		for i in range(handle.index, max(handle.index - self.prefetch - 1, -1), -1):
+			if self.order[i].device_tensor is None and self.order[i].uses > 0:
+				self.fetch(self.order[i])
+		current = torch.cuda.current_stream(self.device)
+		current.wait_event(handle.ready)
+		tensor = handle.device_tensor
+		tensor.record_stream(current)
+		handle.uses -= 1
+		if handle.uses == 0:
+			handle.device_tensor = None
+			self.buffers.release(handle.buffer, handle.ready)
+		return tensor
+
+	def reset(self):
+		# Call once the step's backward has run, the next forward starts a new order. Buffers of tensors backward never
+		# unpacked (or never got to) go back to the pool once the copies queued on the side stream are done
+		done = torch.cuda.Event()
+		done.record(self.stream)
+		for handle in self.order:
+			if handle.uses > 0:
+				handle.uses = 0
+				handle.device_tensor = None
+				self.buffers.release(handle.buffer, done)
+		self.order = []
+		self.packed = {}
+		self.offloaded_bytes = 0
+
+def offload_forward(forward, offloader):
+	def offloaded(*args, **kwargs):
+		if not torch.is_grad_enabled():
+			return forward(*args, **kwargs)
+		with torch.autograd.graph.saved_tensors_hooks(offloader.pack, offloader.unpack):
+			return forward(*args, **kwargs)
+
+	offloaded.offloaded_forward = forward
+	offloaded.checkpointed = getattr(forward, "checkpointed", False)
+	return offloaded
+
+def enable_activation_offload(model, levels, device, prefetch=2, min_bytes=1024 ** 2):
+	# Apply after the checkpoint policy: checkpointed blocks then only offload their inputs, the rest everything they save.
+	# Returns the offloader, reset it after every backward
+	offloader = ActivationOffloader(device, prefetch, min_bytes)
+	for level, level_block in model.level_blocks():
+		if level in levels:
+			for module in level_block:
+				module.forward = offload_forward(module.forward, offloader)
+	return offloader
+
+def disable_activation_offload(model):
+	for module in model.modules():
+		forward = module.__dict__.get("forward")
+		if forward is not None and hasattr(forward, "offloaded_forward"):
+			if getattr(forward.offloaded_forward, "__self__", None) is module:
+				del module.forward
+			else:
+				module.forward = forward.offloaded_forward
+
+def compare_offloading(model, inputs, level_options=[[0], [0, 1]], prefetch=2, autocast_dtype=None, iters=5):
+	# Peak step memory and step time with the given levels offloaded against none, on the model's current checkpointing
+	device = inputs["x"].device
+	autocast = (lambda: torch.autocast(device.type, dtype=autocast_dtype)) if autocast_dtype is not None else nullcontext
+	model.train()
+	results = []
+	for levels in [[]] + level_options:
+		offloader = enable_activation_offload(model, levels, device, prefetch)
+		memory = step_memory(model, inputs, autocast)
+		offloader.reset()
+		torch.cuda.synchronize(device)
+		start = time.perf_counter()
+		for _ in range(iters):
+			run_step(model, inputs, True, autocast)
+			offloader.reset()
+			model.zero_grad(set_to_none=True)
+		torch.cuda.synchronize(device)
+		results.append({"levels": levels, "memory": memory, "seconds": (time.perf_counter() - start) / iters})
+		disable_activation_offload(model)
+	for result in results:
+		result["memory_saved"] = None if result["memory"] is None or results[0]["memory"] is None else results[0]["memory"] - result["memory"]
+		result["slowdown"] = result["seconds"] / max(results[0]["seconds"], 1e-9)
+	return results
+
+def print_offload_results(results):
+	print(f"{'levels':<10}{'memory GB':>11}{'saved GB':>10}{'seconds':>10}{'slowdown':>10}")
+	for result in results:
+		memory = "OOM" if result["memory"] is None else f"{result['memory'] / 1024 ** 3:.2f}"
+		saved = "-" if result["memory_saved"] is None else f"{result['memory_saved'] / 1024 ** 3:.2f}"
+		print(f"{str(result['levels']):<10}{memory:>11}{saved:>10}{result['seconds']:>10.4f}{result['slowdown']:>10.2f}")
+
+def print_tuning_report(report):
+	print(f"{'blocks':>7}{'memory GB':>11}  policy")
+	for entry in report:
+		memory = "OOM" if entry["memory"] is None else f"{entry['memory'] / 1024 ** 3:.2f}"
+		print(f"{entry['blocks']:>7}{memory:>11}  {entry['policy']}")
+
+if __name__ == "__main__":
+	from benchmark_util import tiny_stage_c
+	if not torch.cuda.is_available():
+		raise SystemExit("Checkpoint tuning measures CUDA memory, no CUDA device found.")
+	model = tiny_stage_c().train().to("cuda")
+	policy, report = tune_checkpointing(model, [(16, 24, 24), (16, 32, 32)], 256 * 1024 ** 2, batch_size=4)
+	print_tuning_report(report)
+	print(f"Chosen: {policy}")
+
+	# Offloading on the 3.6B model at 1024x1024 (32x32 latents) with full checkpointing
+	from model_util import StageC
+	from benchmark_util import stage_c_configs
+	del model
+	torch.cuda.empty_cache()
+	model = StageC(**stage_c_configs["3.6B"]).to("cuda", dtype=torch.bfloat16)
+	apply_checkpoint_policy(model, CheckpointPolicy(), "cuda")
+	inputs = stage_c_inputs(model, 4, (16, 32, 32), device="cuda", dtype=torch.bfloat16)
+	print_offload_results(compare_offloading(model, inputs, autocast_dtype=torch.bfloat16))
@@ -0,0 +1,96 @@
+# torch.compile helpers for StageC
+# Every Bucketeer bucket gives a different latent HxW, those are compiled up front (one static graph each) while the
+# text length is marked dynamic so token chunk counts share a graph.
+
+import os
+import time
+import torch
+from contextlib import nullcontext
+from model_util import stage_c_inputs, run_step
+from benchmark_util import synchronize
+
+def set_compile_cache(cache_dir):
+	# Inductor keeps compiled kernels and FX graphs here, later runs with the same shapes load them instead of compiling
+	os.makedirs(cache_dir, exist_ok=True)
+	os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(cache_dir)
+	os.environ["TORCHINDUCTOR_FX_GRAPH_CACHE"] = "1"
+	import torch._inductor.config as inductor_config
+	inductor_config.fx_graph_cache = True
+
+def bucket_latent_shapes(bucketeer, c_latent=16, compression=32):
+	# Latent shapes StageC sees for the bucketeer's image sizes
+	return sorted(set((c_latent, h // compression, w // compression) for h, w in bucketeer.sizes))
+
+def mark_text_dynamic(inputs):
+	# The pooled embedding has one entry per chunk, a single chunk is a size 1 dim that dynamo always specializes.
+	# That one only becomes dynamic from the second chunk count on
+	torch._dynamo.mark_dynamic(inputs["clip_text"], 1)
+	torch._dynamo.maybe_mark_dynamic(inputs["clip_text_pooled"], 1)
+	return inputs
+
+def compile_stage_c(
+	model,
+	latent_shapes,
+	chunk_counts=[1, 2],
+	batch_size=1,
+	device="cpu",
+	dtype=torch.float32,
+	autocast_dtype=None,
+	training=False,
+	cache_dir=None,
+	mode=None,
+	backend="inductor",
+	iters=3
+):
+	# Returns the compiled model and a report of compile time per shape against eager and compiled step time.
+	# The original module keeps its state dict keys, save and optimise that one and only call the compiled one.
+	if cache_dir is not None:
+		set_compile_cache(cache_dir)
+	torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, len(latent_shapes) + 8)
+	model.build_execution_plan()
+	compiled = torch.compile(model, backend=backend, mode=mode)
+
+	device_type = torch.device(device).type
+	autocast = (lambda: torch.autocast(device_type, dtype=autocast_dtype)) if autocast_dtype is not None else nullcontext
+	grad = nullcontext if training else torch.no_grad
+
+	report = []
+	with grad():
+		for shape in latent_shapes:
+			for n_chunks in chunk_counts:
+				inputs = mark_text_dynamic(stage_c_inputs(model, batch_size, shape, n_chunks, device=device, dtype=dtype))
+				synchronize()
+				start = time.perf_counter()
+				run_step(compiled, inputs, training, autocast)
+				synchronize()
+				compile_seconds = time.perf_counter() - start
+
+				timings = {}
+				for name, fn in [("eager", model), ("compiled", compiled)]:
+					synchronize()
+					start = time.perf_counter()
+					for _ in range(iters):
+						run_step(fn, inputs, training, autocast)
+					synchronize()
+					timings[name] = (time.perf_counter() - start) / iters
+				model.zero_grad(set_to_none=True)
+
+				report.append({
+					"shape": tuple(shape), "chunks": n_chunks, "compile_seconds": compile_seconds,
+					"eager_seconds": timings["eager"], "compiled_seconds": timings["compiled"],
+					"speedup": timings["eager"] / max(timings["compiled"], 1e-9)
+				})
+	return compiled, report
+
+def print_report(report):
+	print(f"{'shape':<16}{'chunks':>7}{'compile s':>11}{'eager s':>10}{'compiled s':>12}{'speedup':>9}")
+	for entry in report:
+		print(f"{str(entry['shape']):<16}{entry['chunks']:>7}{entry['compile_seconds']:>11.2f}{entry['eager_seconds']:>10.4f}{entry['compiled_seconds']:>12.4f}{entry['speedup']:>9.2f}")
+	total = sum(entry["compile_seconds"] for entry in report)
+	print(f"Total compile time: {total:.1f}s")
+
+if __name__ == "__main__":
+	from benchmark_util import tiny_stage_c
+	model = tiny_stage_c()
+	compiled, report = compile_stage_c(model, [(16, 8, 8), (16, 6, 10)], chunk_counts=[1, 2], batch_size=2, cache_dir="output/compile_cache")
+	print_report(report)
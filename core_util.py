@@ -13,7 +13,6 @@ from abc import ABC, abstractmethod
 import dataclasses
 from dataclasses import dataclass, _MISSING_TYPE
 from torch.utils.data import Dataset, DataLoader
-from xformers_util import convert_state_dict_normal_attn_to_mha
 import subprocess
 from tqdm import tqdm
 
@@ -130,13 +129,36 @@ def save_model(model, model_id=None, full_path=None, accelerator=None, settings=
 			)
 		create_folder_if_necessary(full_path)
 		checkpoint = model.state_dict()
-		        
-		if settings["flash_attention"]:
-			checkpoint = convert_state_dict_normal_attn_to_mha(checkpoint)
-                                        
 		safe_save(checkpoint, full_path, step, accelerator=accelerator)
 		del checkpoint
 
+# Models
+class ModelRegistry():
+    # Builds each registered model the first time it's requested, models that are never used are never loaded
+    def __init__(self):
+        self.builders = {}
+        self.models = {}
+
+    def register(self, name, builder):
+        self.builders[name] = builder
+
+    def __getitem__(self, name):
+        if name not in self.models:
+            self.models[name] = self.builders[name]()
+        return self.models[name]
+
+    def __contains__(self, name):
+        return name in self.builders
+
+    def loaded(self, name):
+        return name in self.models
+
+    def release(self, *names):
+        for name in names:
+            self.models.pop(name, None)
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
 # Data
 class MultiFilter():
     def __init__(self, rules, default=False):
@@ -1,6 +1,7 @@
 # Custom dataloader implementation for Stable Cascade, based on StableTuner's
 import warnings
 import os
+import math
 import random
 from tqdm import tqdm
 from PIL import Image, ImageFile
@@ -25,10 +26,14 @@ class BucketWalker():
 		if path is not None:
 			self.walk_dataset_folders(self, path)
 
-	def bucketize(self, batch_size):
+	def bucketize(self, batch_size, group_by_tokens=False, token_randomness=2.0):
+		# group_by_tokens sorts every bucket by token chunk count before it is cut into batches, so captions of similar
+		# length share a batch. token_randomness adds uniform noise in [0, token_randomness) chunks to the integer sort key,
+		# only values above 1 let captions of neighbouring chunk counts swap places, 1 or less sorts strictly by length.
 		all_aspects = self.buckets.keys()
 		# Make all buckets divisible by batch size
 		original_count = 0
+		baseline_dataset = []
 		for aspect in all_aspects:
 			aspect_len = len(self.buckets[aspect])
 			original_count += aspect_len
@@ -41,6 +46,9 @@ class BucketWalker():
 				else:
 					print(f"Bucket {aspect} has {aspect_len} images, duplicates not required, nice!")
 				random.shuffle(self.buckets[aspect])
+				if group_by_tokens and self.tokenizer is not None:
+					baseline_dataset.extend(self.buckets[aspect])
+					self.buckets[aspect].sort(key=lambda item: self.get_token_chunks(item) + random.uniform(0, token_randomness))
 				# Finally
 				self.final_dataset.extend(self.buckets[aspect])
 		
@@ -48,6 +56,24 @@ class BucketWalker():
 		print(f"Original Image Count: {original_count}")
 		print(f"Total Image Count:    {total_count}")
 		print(f"Total Step Count:     {total_count // batch_size}")
+		if group_by_tokens and self.tokenizer is not None:
+			print(f"Padded Token Fraction: {self.get_padding_fraction(batch_size):.2%} (ungrouped: {self.get_padding_fraction(batch_size, baseline_dataset):.2%})")
+
+	def get_token_chunks(self, item):
+		if "tokens" not in item:
+			item["tokens"] = self.tokenizer(item["caption"], padding="do_not_pad", verbose=False).input_ids
+		return max(1, math.ceil(len(item["tokens"]) / (self.tokenizer.model_max_length - 2)))
+
+	def get_padding_fraction(self, batch_size, dataset=None):
+		# Fraction of the encoded text chunks in every batch that only exist to pad a sample to the longest caption
+		dataset = self.final_dataset if dataset is None else dataset
+		total_chunks = 0
+		padded_chunks = 0
+		for i in range(0, len(dataset), batch_size):
+			chunks = [self.get_token_chunks(item) for item in dataset[i:i + batch_size]]
+			total_chunks += max(chunks) * len(chunks)
+			padded_chunks += max(chunks) * len(chunks) - sum(chunks)
+		return padded_chunks / total_chunks if total_chunks > 0 else 0.0
 
 	@staticmethod
 	def walk_dataset_folders(self, path):
@@ -147,7 +173,7 @@ class BucketWalker():
 		idx = i % len(self.final_dataset)
 
 		item = self.final_dataset[idx]
-		tokens = self.tokenizer(
+		tokens = item["tokens"] if "tokens" in item else self.tokenizer(
 			item["caption"],
 			padding="do_not_pad",
 			verbose=False
@@ -245,6 +245,110 @@ class LCMSampler(SimpleSampler):
             a_prev, b_prev = a_prev.view(-1, *[1]*(len(x0.shape)-1)), b_prev.view(-1, *[1]*(len(x0.shape)-1))
         return x0 * a_prev + torch.randn_like(epsilon) * b_prev
 
+class MultistepSampler(SimpleSampler):
+    # Base for higher order samplers that reuse the model outputs of earlier steps, history is dropped whenever
+    # a step doesn't continue from where the previous one ended (a new sample() call)
+    def __init__(self, gdf):
+        super().__init__(gdf)
+        self.reset()
+
+    def reset(self):
+        self.x0_history = []
+        self.lambda_history = []
+        self.logSNR_next = None
+
+    def init_x(self, shape):
+        self.reset()
+        return super().init_x(shape)
+
+    def scalers(self, logSNR, ndim):
+        a, b = self.gdf.input_scaler(logSNR)
+        if len(a.shape) == 1:
+            a, b = a.view(-1, *[1]*(ndim-1)), b.view(-1, *[1]*(ndim-1))
+        return a, b
+
+    def __call__(self, x, x0, epsilon, logSNR, logSNR_prev, **kwargs):
+        if self.logSNR_next is None or logSNR.shape != self.logSNR_next.shape or not torch.allclose(logSNR, self.logSNR_next):
+            self.reset()
+        self.logSNR_next = logSNR_prev
+        return super().__call__(x, x0, epsilon, logSNR, logSNR_prev, **kwargs)
+
+class DPMSolverMultistepSampler(MultistepSampler):
+    # DPM-Solver++(2M), data prediction with lambda = log(a / b)
+    def step(self, x, x0, epsilon, logSNR, logSNR_prev):
+        a, b = self.scalers(logSNR, len(x0.shape))
+        a_next, b_next = self.scalers(logSNR_prev, len(x0.shape))
+        lambda_t, lambda_next = a.log() - b.log(), a_next.log() - b_next.log()
+        h = lambda_next - lambda_t
+
+        d = x0
+        if len(self.x0_history) > 0:
+            r = (lambda_t - self.lambda_history[-1]) / h
+            d = (1 + 1 / (2 * r)) * x0 - (1 / (2 * r)) * self.x0_history[-1]
+
+        self.x0_history = [x0]
+        self.lambda_history = [lambda_t]
+        return (b_next / b) * x - a_next * torch.expm1(-h) * d
+
+class UniPCSampler(MultistepSampler):
+    # UniPC (bh2) up to second order with data prediction. The corrector reuses the model output the next step
+    # evaluates anyway, so every step still costs one model call; the last prediction is left uncorrected.
+    def __init__(self, gdf, order=2):
+        super().__init__(gdf)
+        self.order = order
+
+    def reset(self):
+        super().reset()
+        self.x_last = None
+
+    def coefficients(self, h):
+        hh = -h
+        h_phi_1 = torch.expm1(hh)
+        B_h = torch.expm1(hh)
+        b1 = (h_phi_1 / hh - 1) / B_h
+        b2 = ((h_phi_1 / hh - 1) / hh - 0.5) * 2 / B_h
+        return h_phi_1, B_h, b1, b2
+
+    def step(self, x, x0, epsilon, logSNR, logSNR_prev):
+        ndim = len(x0.shape)
+        a, b = self.scalers(logSNR, ndim)
+        lambda_t = a.log() - b.log()
+
+        # Corrector: redo the last update with the model output at the point it predicted
+        if self.x_last is not None:
+            a_s, b_s = self.scalers(self.logSNR_last, ndim)
+            h = lambda_t - self.lambda_history[-1]
+            h_phi_1, B_h, b1, b2 = self.coefficients(h)
+            x_base = (b / b_s) * self.x_last - a * h_phi_1 * self.x0_history[-1]
+            d1_t = x0 - self.x0_history[-1]
+            if self.order_last == 1:
+                x = x_base - a * B_h * 0.5 * d1_t
+            else:
+                r1 = (self.lambda_history[-2] - self.lambda_history[-1]) / h
+                d1 = (self.x0_history[-2] - self.x0_history[-1]) / r1
+                rho_0 = (b1 - b2) / (1 - r1)
+                rho_1 = b1 - rho_0
+                x = x_base - a * B_h * (rho_0 * d1 + rho_1 * d1_t)
+
+        self.x0_history = (self.x0_history + [x0])[-self.order:]
+        self.lambda_history = (self.lambda_history + [lambda_t])[-self.order:]
+        order = len(self.x0_history)
+
+        # Predictor
+        a_next, b_next = self.scalers(logSNR_prev, ndim)
+        h = (a_next.log() - b_next.log()) - lambda_t
+        h_phi_1, B_h, b1, b2 = self.coefficients(h)
+        x_next = (b_next / b) * x - a_next * h_phi_1 * x0
+        if order > 1:
+            r1 = (self.lambda_history[-2] - lambda_t) / h
+            d1 = (self.x0_history[-2] - x0) / r1
+            x_next = x_next - a_next * B_h * 0.5 * d1
+
+        self.x_last = x
+        self.logSNR_last = logSNR
+        self.order_last = order
+        return x_next
+
 # --- Scalers
 class BaseScaler():
     def __init__(self):
@@ -10,7 +10,8 @@ import cv2
 from core_util import load_or_fail
 import warnings
 
-from xformers_util import FlashAttention2D
+from attention_util import get_attention_backend
+from tome_util import bipartite_soft_matching
 
 # Common
 class Linear(torch.nn.Linear):
@@ -22,16 +23,62 @@ class Conv2d(torch.nn.Conv2d):
         return None
         
 class Attention2D(nn.Module):
-    def __init__(self, c, nhead, dropout=0.0):
+    def __init__(self, c, nhead, dropout=0.0, backend="mha"):
         super().__init__()
+        # "mha" runs nn.MultiheadAttention itself, any attention_util backend (or "auto") reuses its weights
+        self.backend = backend
         self.attn = nn.MultiheadAttention(c, nhead, dropout=dropout, bias=True, batch_first=True)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved by the old FlashAttention2D with separate to_q/to_k/to_v
+        if prefix + "attn.to_q.weight" in state_dict:
+            for name in ["weight", "bias"]:
+                qkv = [state_dict.pop(f"{prefix}attn.to_{p}.{name}") for p in "qkv"]
+                state_dict[f"{prefix}attn.in_proj_{name}"] = torch.cat(qkv)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def attend(self, q, k, v, backend=None):
+        # q, k, v are projected Bx(tokens)xC, runs the backend over the heads and the output projection
+        b, n, c = q.shape
+        q, k, v = [t.view(b, -1, self.attn.num_heads, c // self.attn.num_heads).transpose(1, 2) for t in (q, k, v)]
+        dropout = self.attn.dropout if self.training else 0.0
+        x = get_attention_backend(backend or self.backend, q, k, v)(q, k, v, dropout)
+        return self.attn.out_proj(x.transpose(1, 2).reshape(b, n, c))
+
     def forward(self, x, kv, self_attn=False):
         orig_shape = x.shape
         x = x.view(x.size(0), x.size(1), -1).permute(0, 2, 1)  # Bx4xHxW -> Bx(HxW)x4
         if self_attn:
             kv = torch.cat([x, kv], dim=1)
-        x = self.attn(x, kv, kv, need_weights=False)[0]
+        if self.backend == "mha":
+            x = self.attn(x, kv, kv, need_weights=False)[0]
+        else:
+            c = x.size(-1)
+            w_q, w_kv = self.attn.in_proj_weight.split([c, 2 * c])
+            b_q, b_kv = self.attn.in_proj_bias.split([c, 2 * c])
+            q = nn.functional.linear(x, w_q, b_q)
+            k, v = nn.functional.linear(kv, w_kv, b_kv).chunk(2, dim=-1)
+            x = self.attend(q, k, v)
+        x = x.permute(0, 2, 1).view(*orig_shape)
+        return x
+
+    def cond_kv(self, kv):
+        # Keys and values of the conditioning tokens, the in projection is per token so they can be computed once
+        w_q, w_k, w_v = self.attn.in_proj_weight.chunk(3)
+        b_q, b_k, b_v = self.attn.in_proj_bias.chunk(3)
+        return nn.functional.linear(kv, w_k, b_k), nn.functional.linear(kv, w_v, b_v)
+
+    def forward_cached(self, x, cond_k, cond_v, self_attn=False):
+        orig_shape = x.shape
+        x = x.view(x.size(0), x.size(1), -1).permute(0, 2, 1)  # Bx4xHxW -> Bx(HxW)x4
+        w_q, w_k, w_v = self.attn.in_proj_weight.chunk(3)
+        b_q, b_k, b_v = self.attn.in_proj_bias.chunk(3)
+        q = nn.functional.linear(x, w_q, b_q)
+        k, v = cond_k, cond_v
+        if self_attn:
+            k = torch.cat([nn.functional.linear(x, w_k, b_k), cond_k], dim=1)
+            v = torch.cat([nn.functional.linear(x, w_v, b_v), cond_v], dim=1)
+        x = self.attend(q, k, v, backend="sdpa" if self.backend == "mha" else None)
         x = x.permute(0, 2, 1).view(*orig_shape)
         return x
 
@@ -77,20 +124,40 @@ class ResBlock(nn.Module):
         return x + x_res
 
 class AttnBlock(nn.Module):
-    def __init__(self, c, c_cond, nhead, self_attn=True, dropout=0.0, flash_attention=False):
+    def __init__(self, c, c_cond, nhead, self_attn=True, dropout=0.0, flash_attention=False, attention_backend="mha"):
         super().__init__()
         self.self_attn = self_attn
         self.norm = LayerNorm2d(c, elementwise_affine=False, eps=1e-6)
-        if flash_attention:
-            self.attention = FlashAttention2D(c, nhead, dropout) 
-        else:
-            self.attention = Attention2D(c, nhead, dropout)
+        # flash_attention is the xformers backend on the shared weight layout and takes precedence over attention_backend
+        self.attention = Attention2D(c, nhead, dropout, backend="xformers" if flash_attention else attention_backend)
         self.kv_mapper = nn.Sequential(
             nn.SiLU(),
             Linear(c_cond, c)
         )
-
-    def forward(self, x, kv):
+        # Fraction of image tokens merged away before attention, see StageC.set_token_merging
+        self.tome_ratio = 0.0
+        self.tome_training = False
+
+    def merged_attention(self, x, kv, cond_kv=None):
+        # Attention over merged tokens, laid out as a Cx(N)x1 image so the attention modules need no changes
+        tokens = x.flatten(2).transpose(1, 2)
+        merge, unmerge = bipartite_soft_matching(tokens, int(tokens.size(1) * self.tome_ratio))
+        merged = merge(tokens).transpose(1, 2).unsqueeze(-1)
+        if cond_kv is not None:
+            merged = self.attention.forward_cached(merged, *cond_kv, self_attn=self.self_attn)
+        else:
+            merged = self.attention(merged, kv, self_attn=self.self_attn)
+        return unmerge(merged.squeeze(-1).transpose(1, 2)).transpose(1, 2).reshape(x.shape)
+
+    def cond_kv(self, kv):
+        return self.attention.cond_kv(self.kv_mapper(kv))
+
+    def forward(self, x, kv, cond_kv=None):
+        if self.tome_ratio > 0 and (self.tome_training or not self.training):
+            kv = self.kv_mapper(kv) if cond_kv is None else None
+            return x + self.merged_attention(self.norm(x), kv, cond_kv)
+        if cond_kv is not None:
+            return x + self.attention.forward_cached(self.norm(x), *cond_kv, self_attn=self.self_attn)
         kv = self.kv_mapper(kv)
         x = x + self.attention(self.norm(x), kv, self_attn=self.self_attn)
         return x
@@ -496,9 +563,14 @@ class StageC(nn.Module):
     def __init__(self, c_in=16, c_out=16, c_r=64, patch_size=1, c_cond=2048, c_hidden=[2048, 2048], nhead=[32, 32],
                  blocks=[[8, 24], [24, 8]], block_repeat=[[1, 1], [1, 1]], level_config=['CTA', 'CTA'],
                  c_clip_text=1280, c_clip_text_pooled=1280, c_clip_img=768, c_clip_seq=4, kernel_size=3,
-                 dropout=[0.1, 0.1], self_attn=True, t_conds=['sca', 'crp'], switch_level=[False], settings=None, flash_attention=False):
+                 dropout=[0.1, 0.1], self_attn=True, t_conds=['sca', 'crp'], switch_level=[False], settings=None, flash_attention=False, attention_backend="mha"):
         super().__init__()
-        flash_attention = flash_attention
+        if flash_attention and attention_backend not in ["mha", "xformers"]:
+            warnings.warn(f"flash_attention overrides attention_backend={attention_backend}, using xformers.")
+        self.channels_last = False
+        self.execution_plan = None
+        self.up_level_starts = None
+        self.switch_level = switch_level
         self.c_r = c_r
         self.t_conds = t_conds
         self.c_clip_seq = c_clip_seq
@@ -523,7 +595,8 @@ class StageC(nn.Module):
             if block_type == 'C':
                 return ResBlock(c_hidden, c_skip, kernel_size=kernel_size, dropout=dropout)
             elif block_type == 'A':
-                return AttnBlock(c_hidden, c_cond, nhead, self_attn=self_attn, dropout=dropout, flash_attention=flash_attention)
+                return AttnBlock(c_hidden, c_cond, nhead, self_attn=self_attn, dropout=dropout, flash_attention=flash_attention,
+                                 attention_backend=attention_backend)
             elif block_type == 'F':
                 return FeedForwardBlock(c_hidden, dropout=dropout)
             elif block_type == 'T':
@@ -607,6 +680,35 @@ class StageC(nn.Module):
                         if isinstance(layer, nn.Linear):
                             nn.init.constant_(layer.weight, 0)
 
+    def set_token_merging(self, ratios, training=False):
+        # ratios: per level (or one for all) fraction of image tokens merged away in the attention blocks, 0 disables.
+        # Merging always applies at inference, and in training only with training=True
+        if not isinstance(ratios, list):
+            ratios = [ratios] * len(self.down_blocks)
+        for level, level_block in self.level_blocks():
+            for module in level_block:
+                if isinstance(module, AttnBlock):
+                    module.tome_ratio = ratios[level]
+                    module.tome_training = training
+        return self
+
+    def level_blocks(self):
+        # (level, [blocks]) for every down and up level, level 0 is the highest resolution. FSDP wrappers are unwrapped
+        n_levels = len(self.down_blocks)
+        levels = [(i, level_block) for i, level_block in enumerate(self.down_blocks)]
+        levels += [(n_levels - 1 - i, level_block) for i, level_block in enumerate(self.up_blocks)]
+        return [
+            (level, [block._fsdp_wrapped_module if hasattr(block, '_fsdp_wrapped_module') else block for block in level_block])
+            for level, level_block in levels
+        ]
+
+    def set_channels_last(self, enabled=True):
+        # Keeps activations NHWC in memory between blocks. Every permute(0, 2, 3, 1) around the LayerNorms and Linears,
+        # and the view/permute in the attention blocks, then only changes strides instead of copying the activation.
+        self.channels_last = enabled
+        self.to(memory_format=torch.channels_last if enabled else torch.contiguous_format)
+        return self
+
     def _init_weights(self, m):
         if isinstance(m, (nn.Conv2d, nn.Linear)):
             torch.nn.init.xavier_uniform_(m.weight)
@@ -636,72 +738,133 @@ class StageC(nn.Module):
         clip = self.clip_norm(clip)
         return clip
 
-    def _down_encode(self, x, r_embed, clip, cnet=None):
-        level_outputs = []
-        block_group = zip(self.down_blocks, self.down_downscalers, self.down_repeat_mappers)
-        for down_block, downscaler, repmap in block_group:
-            x = downscaler(x)
+    def build_cond_cache(self, clip_text, clip_text_pooled, clip_img):
+        # Conditioning keys and values of every attention block, constant for a whole sampling run
+        clip = self.gen_c_embeddings(clip_text, clip_text_pooled, clip_img)
+        cond_cache = {}
+        for level_block in self.down_blocks + self.up_blocks:
+            for block in level_block:
+                module = block._fsdp_wrapped_module if hasattr(block, '_fsdp_wrapped_module') else block
+                if isinstance(module, AttnBlock):
+                    cond_cache[block] = module.cond_kv(clip)
+        return cond_cache
+
+    def build_execution_plan(self):
+        # Resolves block types (through FSDP wrappers), repeats, skip connections and ControlNet injection points once,
+        # so the forward is a flat loop over (kind, module, arg). Call again after the blocks are wrapped or replaced.
+        def get_kind(block):
+            module = block._fsdp_wrapped_module if hasattr(block, '_fsdp_wrapped_module') else block
+            if isinstance(module, ResBlock):
+                return 'res'
+            elif isinstance(module, AttnBlock):
+                return 'attn'
+            elif isinstance(module, TimestepBlock):
+                return 'time'
+            return 'layer'
+
+        cnet_idx = 0
+        down_plan = []
+        for down_block, downscaler, repmap in zip(self.down_blocks, self.down_downscalers, self.down_repeat_mappers):
+            if not isinstance(downscaler, nn.Identity):
+                down_plan.append(('layer', downscaler, None))
             for i in range(len(repmap) + 1):
                 for block in down_block:
-                    if isinstance(block, ResBlock) or (
-                            hasattr(block, '_fsdp_wrapped_module') and isinstance(block._fsdp_wrapped_module,
-                                                                                  ResBlock)):
-                        if cnet is not None:
-                            next_cnet = cnet()
-                            if next_cnet is not None:
-                                x = x + nn.functional.interpolate(next_cnet, size=x.shape[-2:], mode='bilinear',
-                                                                  align_corners=True)
-                        x = block(x)
-                    elif isinstance(block, AttnBlock) or (
-                            hasattr(block, '_fsdp_wrapped_module') and isinstance(block._fsdp_wrapped_module,
-                                                                                  AttnBlock)):
-                        x = block(x, clip)
-                    elif isinstance(block, TimestepBlock) or (
-                            hasattr(block, '_fsdp_wrapped_module') and isinstance(block._fsdp_wrapped_module,
-                                                                                  TimestepBlock)):
-                        x = block(x, r_embed)
-                    else:
-                        x = block(x)
+                    kind = get_kind(block)
+                    down_plan.append((kind, block, cnet_idx if kind == 'res' else None))
+                    cnet_idx += kind == 'res'
                 if i < len(repmap):
-                    x = repmap[i](x)
-            level_outputs.insert(0, x)
-        return level_outputs
-
-    def _up_decode(self, level_outputs, r_embed, clip, cnet=None):
-        x = level_outputs[0]
-        block_group = zip(self.up_blocks, self.up_upscalers, self.up_repeat_mappers)
-        for i, (up_block, upscaler, repmap) in enumerate(block_group):
+                    down_plan.append(('layer', repmap[i], None))
+            down_plan.append(('save', None, None))
+
+        up_plan = []
+        self.up_level_starts = []
+        n_levels = len(self.up_blocks)
+        for i, (up_block, upscaler, repmap) in enumerate(zip(self.up_blocks, self.up_upscalers, self.up_repeat_mappers)):
+            self.up_level_starts.append(len(up_plan))
+            # Skips only differ in size from x when the level switch actually resamples
+            level = n_levels - 1 - i
+            resize = self.switch_level[level] if level < len(self.switch_level) else True
             for j in range(len(repmap) + 1):
                 for k, block in enumerate(up_block):
-                    if isinstance(block, ResBlock) or (
-                            hasattr(block, '_fsdp_wrapped_module') and isinstance(block._fsdp_wrapped_module,
-                                                                                  ResBlock)):
-                        skip = level_outputs[i] if k == 0 and i > 0 else None
-                        if skip is not None and (x.size(-1) != skip.size(-1) or x.size(-2) != skip.size(-2)):
-                            x = torch.nn.functional.interpolate(x.float(), skip.shape[-2:], mode='bilinear',
-                                                                align_corners=True)
-                        if cnet is not None:
-                            next_cnet = cnet()
-                            if next_cnet is not None:
-                                x = x + nn.functional.interpolate(next_cnet, size=x.shape[-2:], mode='bilinear',
-                                                                  align_corners=True)
-                        x = block(x, skip)
-                    elif isinstance(block, AttnBlock) or (
-                            hasattr(block, '_fsdp_wrapped_module') and isinstance(block._fsdp_wrapped_module,
-                                                                                  AttnBlock)):
-                        x = block(x, clip)
-                    elif isinstance(block, TimestepBlock) or (
-                            hasattr(block, '_fsdp_wrapped_module') and isinstance(block._fsdp_wrapped_module,
-                                                                                  TimestepBlock)):
-                        x = block(x, r_embed)
+                    kind = get_kind(block)
+                    if kind == 'res':
+                        skip_idx = i if k == 0 and i > 0 else None
+                        up_plan.append((kind, block, (cnet_idx, skip_idx, resize and skip_idx is not None)))
+                        cnet_idx += 1
                     else:
-                        x = block(x)
+                        up_plan.append((kind, block, None))
                 if j < len(repmap):
-                    x = repmap[j](x)
-            x = upscaler(x)
+                    up_plan.append(('layer', repmap[j], None))
+            if not isinstance(upscaler, nn.Identity):
+                up_plan.append(('layer', upscaler, None))
+
+        self.execution_plan = (down_plan, up_plan)
+        return self.execution_plan
+
+    def _inject_cnet(self, x, cnet, idx):
+        if idx < len(cnet) and cnet[idx] is not None:
+            x = x + nn.functional.interpolate(cnet[idx], size=x.shape[-2:], mode='bilinear', align_corners=True)
+        return x
+
+    def _down_encode(self, x, r_embed, clip, cnet=None, cond_cache=None, plan=None):
+        if self.execution_plan is None:
+            self.build_execution_plan()
+        level_outputs = []
+        for kind, block, arg in self.execution_plan[0] if plan is None else plan:
+            if kind == 'res':
+                if cnet is not None:
+                    x = self._inject_cnet(x, cnet, arg)
+                x = block(x)
+            elif kind == 'attn':
+                x = block(x, clip) if cond_cache is None else block(x, None, cond_kv=cond_cache[block])
+            elif kind == 'time':
+                x = block(x, r_embed)
+            elif kind == 'layer':
+                x = block(x)
+            else:
+                level_outputs.insert(0, x)
+        return level_outputs
+
+    def _up_decode(self, level_outputs, r_embed, clip, cnet=None, cond_cache=None, plan=None, x=None):
+        if self.execution_plan is None:
+            self.build_execution_plan()
+        x = level_outputs[0] if x is None else x
+        for kind, block, arg in self.execution_plan[1] if plan is None else plan:
+            if kind == 'res':
+                cnet_idx, skip_idx, resize = arg
+                skip = level_outputs[skip_idx] if skip_idx is not None else None
+                if resize and (x.size(-1) != skip.size(-1) or x.size(-2) != skip.size(-2)):
+                    x = torch.nn.functional.interpolate(x.float(), skip.shape[-2:], mode='bilinear',
+                                                        align_corners=True)
+                if cnet is not None:
+                    x = self._inject_cnet(x, cnet, cnet_idx)
+                x = block(x, skip)
+            elif kind == 'attn':
+                x = block(x, clip) if cond_cache is None else block(x, None, cond_kv=cond_cache[block])
+            elif kind == 'time':
+                x = block(x, r_embed)
+            else:
+                x = block(x)
         return x
 
-    def forward(self, x, r, clip_text, clip_text_pooled, clip_img, cnet=None, **kwargs):
+    def _deep_cached_decode(self, x, r_embed, clip, cnet, cond_cache, deep_cache):
+        # Levels from deep_cache.level down only run when the cache is empty, their output (after the upscaler into
+        # the shallower level) is kept and the next steps only run the shallow levels around it
+        if self.execution_plan is None:
+            self.build_execution_plan()
+        down_plan, up_plan = self.execution_plan
+        n_levels = len(self.down_blocks)
+        up_start = self.up_level_starts[n_levels - deep_cache.level]
+        if deep_cache.features is None:
+            level_outputs = self._down_encode(x, r_embed, clip, cnet, cond_cache)
+            deep_cache.features = self._up_decode(level_outputs, r_embed, clip, cnet, cond_cache, plan=up_plan[:up_start])
+        else:
+            down_end = [i for i, (kind, _, _) in enumerate(down_plan) if kind == 'save'][deep_cache.level - 1] + 1
+            shallow_outputs = self._down_encode(x, r_embed, clip, cnet, cond_cache, plan=down_plan[:down_end])
+            level_outputs = [None] * (n_levels - deep_cache.level) + shallow_outputs
+        return self._up_decode(level_outputs, r_embed, clip, cnet, cond_cache, plan=up_plan[up_start:], x=deep_cache.features)
+
+    def forward(self, x, r, clip_text, clip_text_pooled, clip_img, cnet=None, cond_cache=None, deep_cache=None, **kwargs):
         # Process the conditioning embeddings
 
         r_embed = self.gen_r_embedding(r)
@@ -709,15 +872,20 @@ class StageC(nn.Module):
             t_cond = kwargs.get(c, torch.zeros_like(r))
             r_embed = torch.cat([r_embed, self.gen_r_embedding(t_cond)], dim=1)
         
-        clip = self.gen_c_embeddings(clip_text, clip_text_pooled, clip_img)
+        clip = self.gen_c_embeddings(clip_text, clip_text_pooled, clip_img) if cond_cache is None else None
 
         # Model Blocks
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
         x = self.embedding(x)
-        if cnet is not None:
-            cnet = ControlNetDeliverer(cnet)
 
-        level_outputs = self._down_encode(x, r_embed, clip, cnet)
-        x = self._up_decode(level_outputs, r_embed, clip, cnet)
+        if deep_cache is not None:
+            x = self._deep_cached_decode(x, r_embed, clip, cnet, cond_cache, deep_cache)
+        else:
+            level_outputs = self._down_encode(x, r_embed, clip, cnet, cond_cache)
+            x = self._up_decode(level_outputs, r_embed, clip, cnet, cond_cache)
+        if self.channels_last:
+            return self.clf(x).contiguous()
         return self.clf(x)
 
     def update_weights_ema(self, src_model, beta=0.999):
@@ -726,10 +894,96 @@ class StageC(nn.Module):
         for self_buffers, src_buffers in zip(self.buffers(), src_model.buffers()):
             self_buffers.data = self_buffers.data * beta + src_buffers.data.clone().to(self_buffers.device) * (1 - beta)
 
+class CondCachedStageC():
+    # Drop-in model for GDF.sample, the conditioning keys and values are built on the first step and reused
+    # for as long as the same conditioning tensors are passed in (sample() builds its CFG inputs once per call)
+    def __init__(self, model):
+        self.model = model
+        self.inputs = None
+        self.cond_cache = None
+
+    def reset(self):
+        self.inputs = None
+        self.cond_cache = None
+
+    def __call__(self, x, r, clip_text, clip_text_pooled, clip_img, **kwargs):
+        inputs = (clip_text, clip_text_pooled, clip_img)
+        if self.inputs is None or any(a is not b for a, b in zip(inputs, self.inputs)):
+            self.cond_cache = self.model.build_cond_cache(*inputs)
+            self.inputs = inputs
+        return self.model(x, r, clip_text, clip_text_pooled, clip_img, cond_cache=self.cond_cache, **kwargs)
+
+class DeepCache():
+    # Output of the levels from `level` down on the last full step, see DeepCachedStageC
+    def __init__(self, level=1):
+        self.level = level
+        self.features = None
+
+class DeepCachedStageC():
+    # Drop-in model for GDF.sample (DeepCache). Deep features change little between adjacent steps, so the deep levels
+    # only run every `interval` steps and the steps in between reuse them, running the high resolution level alone.
+    # model is a StageC or a CondCachedStageC. A new sampling run (r not decreasing) or a new shape starts over
+    def __init__(self, model, interval=3, level=1):
+        self.model = model
+        self.interval = interval
+        self.cache = DeepCache(level)
+        self.step = 0
+        self.last_r = None
+        self.shape = None
+
+    def reset(self):
+        self.cache.features = None
+        self.step = 0
+        self.last_r = None
+        self.shape = None
+        if hasattr(self.model, 'reset'):
+            self.model.reset()
+
+    def __call__(self, x, r, clip_text, clip_text_pooled, clip_img, **kwargs):
+        if self.shape != x.shape or (self.last_r is not None and (r >= self.last_r).all()):
+            self.cache.features = None
+            self.step = 0
+        if self.step % self.interval == 0:
+            self.cache.features = None
+        self.step += 1
+        self.shape = x.shape
+        # Callers may reuse one r buffer across steps
+        self.last_r = r.clone()
+        return self.model(x, r, clip_text, clip_text_pooled, clip_img, deep_cache=self.cache, **kwargs)
+
+def stage_c_inputs(model, batch_size=2, shape=(16, 24, 24), n_chunks=1, device="cpu", dtype=torch.float32):
+    # Random StageC inputs of a given latent shape and text chunk count, for warmups and measurements
+    c_text = model.clip_txt_mapper.in_features
+    c_img = model.clip_img_mapper.in_features
+    return {
+        "x": torch.randn(batch_size, *shape, device=device, dtype=dtype),
+        "r": torch.rand(batch_size, device=device),
+        "clip_text": torch.randn(batch_size, 77 * n_chunks, c_text, device=device, dtype=dtype),
+        "clip_text_pooled": torch.randn(batch_size, n_chunks, c_text, device=device, dtype=dtype),
+        "clip_img": torch.randn(batch_size, 1, c_img, device=device, dtype=dtype)
+    }
+
+def run_step(model, inputs, training, autocast):
+    # One forward, and a backward when training
+    with autocast():
+        pred = model(**inputs)
+    if training:
+        pred.float().mean().backward()
+    return pred
+
 
 from torch.utils.checkpoint import checkpoint
 from typing import Callable
 
+# One dummy per device for every checkpointed block, see create_checkpointed_forward
+checkpoint_dummies = {}
+
+def get_checkpoint_dummy(device):
+    device = torch.device(device)
+    if device not in checkpoint_dummies:
+        checkpoint_dummies[device] = torch.zeros((1,), device=device, requires_grad=True)
+    return checkpoint_dummies[device]
+
 def create_checkpointed_forward(orig_module: nn.Module, device: torch.device) -> Callable:
     orig_forward = orig_module.forward
 
@@ -748,24 +1002,51 @@ def create_checkpointed_forward(orig_module: nn.Module, device: torch.device) ->
             *args,
             **kwargs
     ):
-        dummy = torch.zeros((1,), device=device)
-        dummy.requires_grad_(True)
-
         return checkpoint(
             custom_forward,
-            dummy,
+            get_checkpoint_dummy(device),
             *args,
             **kwargs,
             use_reentrant=False
         )
 
+    forward.checkpointed = True
     return forward
 
-def enable_checkpointing_for_stable_cascade_blocks(orig_module: nn.Module, device: torch.device):
-    for name, child_module in orig_module.named_modules():
-        if isinstance(child_module, ResBlock):
-            child_module.forward = create_checkpointed_forward(child_module, device)
-        if isinstance(child_module, AttnBlock):
-            child_module.forward = create_checkpointed_forward(child_module, device)
-        if isinstance(child_module, TimestepBlock):
-            child_module.forward = create_checkpointed_forward(child_module, device)
\ No newline at end of file
+class CheckpointPolicy():
+    # Which StageC blocks recompute their activations in backward instead of keeping them.
+    # block_types: class names of the blocks to checkpoint, levels: level indices to checkpoint (None for every level),
+    # every: only every k-th matching block of a level. TimestepBlocks are cheap to keep and skipped by default
+    def __init__(self, block_types=["ResBlock", "AttnBlock"], levels=None, every=1):
+        self.block_types = list(block_types)
+        self.levels = levels
+        self.every = every
+
+    def select(self, model):
+        selected = []
+        for level, level_block in model.level_blocks():
+            if self.levels is not None and level not in self.levels:
+                continue
+            matching = [module for module in level_block if type(module).__name__ in self.block_types]
+            selected += matching[::self.every]
+        return selected
+
+    def __repr__(self):
+        return f"CheckpointPolicy(block_types={self.block_types}, levels={self.levels}, every={self.every})"
+
+def disable_checkpointing(model: nn.Module):
+    # Restores the plain forward of every checkpointed block
+    for module in model.modules():
+        if getattr(module.__dict__.get("forward"), "checkpointed", False):
+            del module.forward
+
+def apply_checkpoint_policy(model: nn.Module, policy: CheckpointPolicy, device: torch.device):
+    # Replaces whatever checkpointing the model had, returns the checkpointed blocks
+    disable_checkpointing(model)
+    selected = policy.select(model)
+    for module in selected:
+        module.forward = create_checkpointed_forward(module, device)
+    return selected
+
+def enable_checkpointing_for_stable_cascade_blocks(orig_module: nn.Module, device: torch.device, policy: CheckpointPolicy = None):
+    return apply_checkpoint_policy(orig_module, CheckpointPolicy() if policy is None else policy, device)
@@ -0,0 +1,149 @@
+# Batched StageC sampling for evaluation grids and dataset previews
+
+import torch
+from tqdm import tqdm
+from gdf_util import DDIMSampler
+from model_util import CondCachedStageC, DeepCachedStageC
+
+class SampleRequest():
+	def __init__(self, prompt, seed, cfg=4.0):
+		self.prompt = prompt
+		self.seed = seed
+		self.cfg = cfg
+
+def sample_grid(prompts, seeds, cfgs=[4.0]):
+	# Every prompt with every seed and cfg scale
+	return [SampleRequest(prompt, seed, cfg) for prompt in prompts for seed in seeds for cfg in cfgs]
+
+class SamplingEngine():
+	def __init__(
+		self,
+		gdf,
+		model,
+		prompt_cache,
+		device="cpu",
+		dtype=torch.float32,
+		max_batch_size=16,
+		memory_budget=None,
+		sampler_fn=DDIMSampler,
+		c_clip_img=768,
+		deep_cache_interval=None
+	):
+		# prompt_cache: PromptEmbeddingCache, the unconditional side is the empty prompt as in caption dropout
+		# memory_budget: bytes of device memory sampling may use, the batch size is measured against it on CUDA
+		# sampler_fn(gdf) -> sampler, a new one per batch so multistep samplers start with a clean history
+		# deep_cache_interval: recompute StageC's deep level only every this many steps, see DeepCachedStageC
+		self.gdf = gdf
+		self.model = CondCachedStageC(model)
+		self.sample_model = self.model if deep_cache_interval is None else DeepCachedStageC(self.model, deep_cache_interval)
+		self.prompt_cache = prompt_cache
+		self.device = torch.device(device)
+		self.dtype = dtype
+		self.max_batch_size = max_batch_size
+		self.memory_budget = memory_budget
+		self.sampler_fn = sampler_fn
+		self.c_clip_img = c_clip_img
+		self.batch_sizes = {}
+
+	def conditioning(self, prompts):
+		# Conditional and unconditional inputs stacked once, [cond; uncond] along the batch
+		clip_text, clip_text_pooled = self.prompt_cache(list(prompts) + [""], device=self.device)
+		clip_text = torch.cat([clip_text[:-1], clip_text[-1:].expand(len(prompts), -1, -1)])
+		clip_text_pooled = torch.cat([clip_text_pooled[:-1], clip_text_pooled[-1:].expand(len(prompts), -1, -1)])
+		clip_img = torch.zeros(clip_text.size(0), 1, self.c_clip_img, device=self.device)
+		return {
+			"clip_text": clip_text.to(self.dtype),
+			"clip_text_pooled": clip_text_pooled.to(self.dtype),
+			"clip_img": clip_img.to(self.dtype)
+		}
+
+	def init_x(self, seeds, shape):
+		# Noise comes from each sample's own seed, so results don't depend on how requests were packed
+		x = []
+		for seed in seeds:
+			generator = torch.Generator().manual_seed(seed)
+			x.append(torch.randn(*shape, generator=generator))
+		return torch.stack(x).to(self.device)
+
+	def forward_memory(self, batch_size, shape, n_chunks):
+		torch.cuda.empty_cache()
+		torch.cuda.reset_peak_memory_stats(self.device)
+		start = torch.cuda.memory_allocated(self.device)
+		x = torch.zeros(batch_size * 2, *shape, device=self.device, dtype=self.dtype)
+		r = torch.zeros(batch_size * 2, device=self.device)
+		text_dim = self.prompt_cache.get_padding()["text_cache"].size(-1)
+		clip_text = torch.zeros(batch_size * 2, n_chunks * self.prompt_cache.tokenizer.model_max_length, text_dim, device=self.device, dtype=self.dtype)
+		clip_text_pooled = torch.zeros(batch_size * 2, n_chunks, clip_text.size(-1), device=self.device, dtype=self.dtype)
+		clip_img = torch.zeros(batch_size * 2, 1, self.c_clip_img, device=self.device, dtype=self.dtype)
+		self.model.model(x, r, clip_text, clip_text_pooled, clip_img)
+		return torch.cuda.max_memory_allocated(self.device) - start
+
+	def get_batch_size(self, shape, n_chunks):
+		if self.memory_budget is None or self.device.type != "cuda":
+			return self.max_batch_size
+		key = (tuple(shape), n_chunks)
+		if key not in self.batch_sizes:
+			# Peak memory is close to linear in the batch, fit it from two small forwards
+			with torch.no_grad():
+				one = self.forward_memory(1, shape, n_chunks)
+				two = self.forward_memory(2, shape, n_chunks)
+			per_sample = max(two - one, 1)
+			fixed = max(one - per_sample, 0)
+			self.batch_sizes[key] = int(max(1, min(self.max_batch_size, (self.memory_budget - fixed) // per_sample)))
+		return self.batch_sizes[key]
+
+	def sample_batch(self, requests, shape, timesteps, t_start=1.0, t_end=0.0, shift=1, cfg_rho=0.0, sampler_params=None):
+		sampler_params = {} if sampler_params is None else sampler_params
+		sampler = self.sampler_fn(self.gdf)
+		batch_size = len(requests)
+		model_inputs = self.conditioning([request.prompt for request in requests])
+		cfg = torch.tensor([request.cfg for request in requests], device=self.device, dtype=torch.float32).view(-1, 1, 1, 1)
+
+		r_range = torch.linspace(t_start, t_end, timesteps + 1)
+		logSNR_range = self.gdf.schedule(r_range, shift=shift)[:, None].expand(-1, batch_size).to(self.device)
+
+		x = self.init_x([request.seed for request in requests], shape)
+		# The doubled input is written in place every step instead of concatenated
+		x_doubled = torch.empty(batch_size * 2, *shape, device=self.device, dtype=x.dtype)
+		r_doubled = torch.empty(batch_size * 2, device=self.device)
+		x0 = x
+		for i in range(timesteps):
+			x_doubled[:batch_size].copy_(x)
+			x_doubled[batch_size:].copy_(x)
+			noise_cond = self.gdf.noise_cond(logSNR_range[i])
+			r_doubled[:batch_size].copy_(noise_cond)
+			r_doubled[batch_size:].copy_(noise_cond)
+			pred, pred_unconditional = self.sample_model(x_doubled, r_doubled, **model_inputs).float().chunk(2)
+			pred_cfg = torch.lerp(pred_unconditional, pred, cfg)
+			if cfg_rho > 0:
+				# Rescaled per sample, one sample's guidance must not depend on its batch neighbours
+				std_pos, std_cfg = pred.std(dim=[1, 2, 3], keepdim=True), pred_cfg.std(dim=[1, 2, 3], keepdim=True)
+				pred = cfg_rho * (pred_cfg * std_pos / (std_cfg + 1e-9)) + pred_cfg * (1 - cfg_rho)
+			else:
+				pred = pred_cfg
+			x0, epsilon = self.gdf.undiffuse(x, logSNR_range[i], pred)
+			x = sampler(x, x0, epsilon, logSNR_range[i], logSNR_range[i + 1], **sampler_params)
+		self.sample_model.reset()
+		return x0
+
+	def sample(self, requests, shape, timesteps=20, **kwargs):
+		# requests: [SampleRequest], shape: latent shape of one sample (C, H, W). Returns x0 per request, in order
+		tokenizer = self.prompt_cache.tokenizer
+		chunk_size = tokenizer.model_max_length - 2
+
+		# Only prompts with the same chunk count share a batch, padding chunks would change the result otherwise
+		groups = {}
+		for i, request in enumerate(requests):
+			n_chunks = max(1, -(-len(tokenizer(request.prompt, padding="do_not_pad", verbose=False).input_ids) // chunk_size))
+			groups.setdefault(n_chunks, []).append(i)
+
+		outputs = [None] * len(requests)
+		with torch.no_grad():
+			for n_chunks, indices in groups.items():
+				batch_size = self.get_batch_size(shape, n_chunks)
+				for start in tqdm(range(0, len(indices), batch_size), desc=f"Sampling ({n_chunks} chunk)"):
+					batch = indices[start:start + batch_size]
+					x0 = self.sample_batch([requests[i] for i in batch], shape, timesteps, **kwargs)
+					for i, sample in zip(batch, x0.cpu()):
+						outputs[i] = sample
+		return outputs
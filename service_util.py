@@ -0,0 +1,339 @@
+# Encoder service for Stable Cascade training
+# Hosts the CLIP text and image encoders once per node and batches requests from every training process over a Unix socket.
+# Tensors travel through torch's multiprocessing reductions, CUDA results are shared by IPC handle rather than copied.
+
+import os
+import time
+import queue
+import threading
+import types
+import torch
+import torch.multiprocessing
+from collections import deque
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+from multiprocessing.reduction import ForkingPickler
+from cache_util import map_tensors
+
+def use_shared_tensors():
+	# File descriptors can only be passed to child processes, unrelated processes share CPU tensors through shm files
+	torch.multiprocessing.set_sharing_strategy("file_system")
+
+def dumps(obj):
+	return bytes(ForkingPickler.dumps(obj))
+
+def loads(data):
+	return ForkingPickler.loads(data)
+
+# Requests are unpickled, so only processes holding the authkey may connect. Without a configured key the service
+# generates one and leaves it next to the socket, readable by the same user only, for the training ranks to pick up
+def authkey_path(address):
+	return address + ".key"
+
+def write_authkey(address, authkey):
+	path = authkey_path(address)
+	if os.path.exists(path):
+		os.remove(path)
+	fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+	with os.fdopen(fd, "wb") as file:
+		file.write(authkey)
+
+def read_authkey(address):
+	with open(authkey_path(address), "rb") as file:
+		return file.read()
+
+class EncodeRequest():
+	def __init__(self, kind, args):
+		self.kind = kind
+		self.args = args
+		self.result = None
+		self.error = None
+		self.done = threading.Event()
+		if kind == "text":
+			self.rows = args[0][0].shape[0]
+			self.key = ("text", len(args[0]))
+		elif kind == "image":
+			self.rows = args[0].shape[0]
+			self.key = ("image", tuple(args[0].shape[1:]))
+		else:
+			# Dropout embeddings are only requested once per process
+			self.rows = args[0]
+			self.key = (kind, id(self))
+
+class EncoderService():
+	def __init__(
+		self,
+		address,
+		encode_text_fn,
+		encode_image_fn,
+		max_batch_size=64,
+		batch_window=0.005,
+		authkey=None
+	):
+		# encode_text_fn(tokens, att_mask, batch_size, dropout) -> (text_embeddings, text_embeddings_pool)
+		# encode_image_fn(images) -> image_embeds for clip preprocessed images
+		# authkey: bytes every client must present, a random one written to authkey_path(address) when None
+		self.address = address
+		self.encode_text_fn = encode_text_fn
+		self.encode_image_fn = encode_image_fn
+		self.max_batch_size = max_batch_size
+		self.batch_window = batch_window
+		self.authkey = os.urandom(32) if authkey is None else authkey
+		self.write_key = authkey is None
+		self.requests = queue.Queue()
+		self.waiting = deque()
+		self.stop = threading.Event()
+		self.threads = []
+		self.listener = None
+		self.batches = 0
+		self.served = 0
+		use_shared_tensors()
+
+	def next_request(self, key, timeout):
+		for request in self.waiting:
+			if key is None or request.key == key:
+				self.waiting.remove(request)
+				return request
+		while True:
+			try:
+				request = self.requests.get(timeout=timeout)
+			except queue.Empty:
+				return None
+			if key is None or request.key == key:
+				return request
+			# Requests that can't join this batch are picked up by the next one
+			self.waiting.append(request)
+
+	def next_group(self):
+		first = self.next_request(None, 0.1)
+		if first is None:
+			return []
+		group = [first]
+		rows = first.rows
+		deadline = time.monotonic() + self.batch_window
+		while rows < self.max_batch_size and first.kind != "dropout":
+			timeout = deadline - time.monotonic()
+			if timeout <= 0:
+				break
+			request = self.next_request(first.key, timeout)
+			if request is None:
+				break
+			group.append(request)
+			rows += request.rows
+		return group
+
+	def encode(self, group):
+		kind = group[0].kind
+		rows = [request.rows for request in group]
+		with torch.no_grad():
+			if kind == "text":
+				n_chunks = len(group[0].args[0])
+				tokens = [torch.cat([request.args[0][i] for request in group]) for i in range(n_chunks)]
+				att_mask = [torch.cat([request.args[1][i] for request in group]) for i in range(n_chunks)]
+				outputs = self.encode_text_fn(tokens, att_mask, sum(rows), False)
+			elif kind == "image":
+				outputs = (self.encode_image_fn(torch.cat([request.args[0] for request in group])),)
+			else:
+				outputs = self.encode_text_fn([], [], rows[0], True)
+
+		# Every request gets a view of the batched output
+		offset = 0
+		for request, size in zip(group, rows):
+			request.result = tuple(output[offset:offset + size] for output in outputs)
+			offset += size
+
+	def run(self):
+		while not self.stop.is_set():
+			group = self.next_group()
+			if len(group) == 0:
+				continue
+			try:
+				self.encode(group)
+			except Exception as e:
+				for request in group:
+					request.error = repr(e)
+			self.batches += 1
+			self.served += len(group)
+			for request in group:
+				request.done.set()
+
+	def handle(self, conn):
+		with conn:
+			while not self.stop.is_set():
+				try:
+					kind, args = loads(conn.recv_bytes())
+				except (EOFError, OSError):
+					break
+				request = EncodeRequest(kind, args)
+				self.requests.put(request)
+				request.done.wait()
+				reply = ("error", request.error) if request.error is not None else ("ok", request.result)
+				try:
+					conn.send_bytes(dumps(reply))
+				except OSError:
+					break
+
+	def serve_forever(self):
+		if os.path.exists(self.address):
+			os.remove(self.address)
+		if self.write_key:
+			write_authkey(self.address, self.authkey)
+		# The socket is created owner only, other users can't even attempt the handshake
+		umask = os.umask(0o077)
+		try:
+			listener = Listener(self.address, family="AF_UNIX", authkey=self.authkey)
+		finally:
+			os.umask(umask)
+		os.chmod(self.address, 0o600)
+		self.listener = listener
+		worker = threading.Thread(target=self.run, daemon=True)
+		worker.start()
+		self.threads.append(worker)
+		while not self.stop.is_set():
+			try:
+				conn = self.listener.accept()
+			except AuthenticationError:
+				# A client with the wrong key, keep serving the others
+				continue
+			except OSError:
+				break
+			handler = threading.Thread(target=self.handle, args=(conn,), daemon=True)
+			handler.start()
+			self.threads.append(handler)
+
+	def start(self):
+		# Serve from a background thread, returns once the socket accepts connections
+		thread = threading.Thread(target=self.serve_forever, daemon=True)
+		thread.start()
+		while self.listener is None and thread.is_alive():
+			time.sleep(0.01)
+		return self
+
+	def close(self):
+		self.stop.set()
+		if self.listener is not None:
+			self.listener.close()
+		if os.path.exists(self.address):
+			os.remove(self.address)
+		if self.write_key and os.path.exists(authkey_path(self.address)):
+			os.remove(authkey_path(self.address))
+
+class EncoderClient():
+	def __init__(self, address, device="cpu", authkey=None, timeout=60):
+		# authkey: the service's key, read from authkey_path(address) when None
+		use_shared_tensors()
+		self.device = torch.device(device)
+		# Training processes may be launched before the service finished loading its models
+		deadline = time.monotonic() + timeout
+		while not os.path.exists(address):
+			if time.monotonic() > deadline:
+				raise TimeoutError(f"No encoder service listening at {address}")
+			time.sleep(0.5)
+		if authkey is None:
+			authkey = read_authkey(address)
+		self.conn = Client(address, family="AF_UNIX", authkey=authkey)
+		# The conditioning producer may encode from its own thread
+		self.lock = threading.Lock()
+
+	def request(self, kind, *args):
+		with self.lock:
+			self.conn.send_bytes(dumps((kind, args)))
+			status, result = loads(self.conn.recv_bytes())
+		if status == "error":
+			raise RuntimeError(f"Encoder service failed: {result}")
+		return map_tensors(result, lambda tensor: tensor.to(self.device))
+
+	def encode_text(self, tokens, att_mask, batch_size, dropout=False):
+		if dropout:
+			return self.request("dropout", batch_size)
+		# Token ids are tiny, send them through shared memory rather than the rank's device
+		tokens = [chunk.cpu() for chunk in tokens]
+		att_mask = [chunk.cpu() for chunk in att_mask]
+		return self.request("text", tokens, att_mask)
+
+	def encode_image(self, images):
+		return self.request("image", images.contiguous())[0]
+
+	def close(self):
+		self.conn.close()
+
+# Stand-in with the same API that calls the encoders in process, no socket or GPU needed
+class LocalEncoderClient():
+	def __init__(self, encode_text_fn, encode_image_fn, device="cpu"):
+		self.encode_text_fn = encode_text_fn
+		self.encode_image_fn = encode_image_fn
+		self.device = torch.device(device)
+
+	def encode_text(self, tokens, att_mask, batch_size, dropout=False):
+		with torch.no_grad():
+			outputs = self.encode_text_fn(tokens, att_mask, batch_size, dropout)
+		return map_tensors(outputs, lambda tensor: tensor.to(self.device))
+
+	def encode_image(self, images):
+		with torch.no_grad():
+			return self.encode_image_fn(images).to(self.device)
+
+	def close(self):
+		pass
+
+def serve(settings, address, device):
+	from text_util import text_cache
+	from transformers import AutoTokenizer, CLIPTextModelWithProjection, CLIPVisionModelWithProjection
+
+	main_dtype = getattr(torch, settings["dtype"]) if "dtype" in settings and settings["dtype"] != "tf32" else torch.float32
+	print("Loading CLIP Text Encoder")
+	text_model = CLIPTextModelWithProjection.from_pretrained(settings["clip_text_model_name"]).requires_grad_(False).to(device, dtype=main_dtype)
+	text_model.eval()
+	print("Loading CLIP Image Encoder")
+	image_model = CLIPVisionModelWithProjection.from_pretrained(settings["clip_image_model_name"]).requires_grad_(False).to(device, dtype=main_dtype)
+	image_model.eval()
+	tokenizer = AutoTokenizer.from_pretrained(settings["clip_text_model_name"])
+	# text_cache only needs the device from the accelerator
+	accelerator = types.SimpleNamespace(device=torch.device(device))
+
+	def encode_text(tokens, att_mask, batch_size, dropout):
+		return text_cache(dropout, text_model, accelerator, tokens, att_mask, tokenizer, settings, batch_size)
+
+	def encode_image(images):
+		return image_model(images.to(device, dtype=main_dtype)).image_embeds
+
+	authkey = settings["encoder_service_authkey"]
+	service = EncoderService(
+		address, encode_text, encode_image,
+		max_batch_size=settings["encoder_service_max_batch_size"],
+		batch_window=settings["encoder_service_batch_window"],
+		authkey=authkey.encode() if authkey is not None else None
+	)
+	print(f"Serving encoders at {address}")
+	try:
+		service.serve_forever()
+	finally:
+		service.close()
+
+if __name__ == "__main__":
+	import argparse
+	import yaml
+	import json
+	parser = argparse.ArgumentParser(description="Hosts the CLIP encoders for every training process on this node.")
+	parser.add_argument("--yaml", default=None, type=str, help="The training configuration YAML")
+	parser.add_argument("--address", default=None, type=str, help="Unix socket path, defaults to encoder_service from the config")
+	parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", type=str)
+	args = parser.parse_args()
+
+	settings = {
+		"clip_image_model_name": "openai/clip-vit-large-patch14",
+		"clip_text_model_name": "laion/CLIP-ViT-bigG-14-laion2B-39B-b160k",
+		"clip_skip": -1,
+		"max_token_limit": 75,
+		"encoder_service": None,
+		"encoder_service_max_batch_size": 64,
+		"encoder_service_batch_window": 0.005,
+		"encoder_service_authkey": None,
+	}
+	if args.yaml is not None:
+		with open(args.yaml, "r", encoding="utf-8") as file:
+			settings = settings | (json.load(file) if args.yaml.endswith(".json") else yaml.safe_load(file))
+	address = args.address or settings["encoder_service"]
+	if address is None:
+		raise ValueError("No socket address supplied, set encoder_service or pass --address.")
+	serve(settings, address, args.device)
@@ -0,0 +1,45 @@
+import pytest
+import torch
+from attention_util import attention_chunk_sizes, chunked_attention, math_attention, sdpa_attention
+
+BATCH, HEADS, N_QUERIES, N_KEYS, HEAD_DIM = 2, 1, 37, 29, 8
+
+# Budgets for 20 query rows of every key (a single key pass) and for 200 scores (query and key tiles), both leave tails
+TILE_BYTES = 4 * 3 * BATCH * HEADS
+BUDGETS = [
+	(TILE_BYTES * 20 * N_KEYS, (20, N_KEYS)),
+	(TILE_BYTES * 200, (16, 16)),
+]
+
+def attention_inputs():
+	generator = torch.Generator().manual_seed(0)
+	return [torch.randn(BATCH, HEADS, n, HEAD_DIM, generator=generator).requires_grad_(True) for n in (N_QUERIES, N_KEYS, N_KEYS)]
+
+def forward_and_grads(fn, q, k, v):
+	weight = torch.linspace(-1, 1, HEAD_DIM)
+	out = fn(q, k, v)
+	grads = torch.autograd.grad((out * weight).sum(), (q, k, v))
+	return out.detach(), grads
+
+@pytest.mark.parametrize("budget, tiles", BUDGETS)
+def test_chunk_sizes_leave_tails(budget, tiles):
+	q_chunk, k_chunk = attention_chunk_sizes(BATCH * HEADS, N_QUERIES, N_KEYS, budget)
+	assert (q_chunk, k_chunk) == tiles
+	assert q_chunk < N_QUERIES and N_QUERIES % q_chunk != 0
+	assert k_chunk == N_KEYS or N_KEYS % k_chunk != 0
+
+@pytest.mark.parametrize("budget, tiles", BUDGETS)
+@pytest.mark.parametrize("reference", [math_attention, sdpa_attention])
+def test_chunked_attention_matches_reference(budget, tiles, reference):
+	q, k, v = attention_inputs()
+	expected, expected_grads = forward_and_grads(reference, q, k, v)
+	output, grads = forward_and_grads(lambda q, k, v: chunked_attention(q, k, v, memory_budget=budget), q, k, v)
+	assert torch.allclose(output, expected, atol=1e-5, rtol=1e-5)
+	for grad, expected_grad in zip(grads, expected_grads):
+		assert torch.allclose(grad, expected_grad, atol=1e-5, rtol=1e-5)
+
+def test_chunked_attention_without_grad():
+	q, k, v = [t.detach() for t in attention_inputs()]
+	with torch.no_grad():
+		output = chunked_attention(q, k, v, memory_budget=BUDGETS[1][0])
+	assert torch.allclose(output, math_attention(q, k, v), atol=1e-5, rtol=1e-5)
@@ -0,0 +1,19 @@
+import torch
+from model_util import stage_c_inputs
+from benchmark_util import tiny_stage_c
+from compile_util import compile_stage_c
+
+def test_compiled_stage_c_matches_eager_without_recompiles():
+	torch._dynamo.reset()
+	torch.manual_seed(0)
+	model = tiny_stage_c()
+	shapes = [(16, 8, 8), (16, 6, 10)]
+	compiled, report = compile_stage_c(model, shapes, chunk_counts=[1, 2], batch_size=2, iters=1)
+	assert len(report) == len(shapes) * 2
+
+	# Every bucket shape and chunk count was warmed up, none of them may compile again
+	with torch.no_grad(), torch._dynamo.config.patch(error_on_recompile=True):
+		for shape in shapes:
+			for n_chunks in [1, 2]:
+				inputs = stage_c_inputs(model, 2, shape, n_chunks)
+				assert torch.allclose(compiled(**inputs), model(**inputs), atol=1e-4, rtol=1e-4)
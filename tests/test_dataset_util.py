@@ -0,0 +1,44 @@
+import random
+from types import SimpleNamespace
+from dataset_util import BucketWalker
+
+class FakeTokenizer():
+	model_max_length = 77
+
+	def __call__(self, caption, padding=None, verbose=None):
+		# One token per word plus BOS and EOS
+		return SimpleNamespace(input_ids=list(range(len(caption.split()) + 2)))
+
+def build_walker(seed):
+	random.seed(seed)
+	walker = BucketWalker(tokenizer=FakeTokenizer())
+	for aspect in ["1.00", "0.75"]:
+		walker.buckets[aspect] = [
+			{"path": f"{aspect}_{i}.jpg", "caption": " ".join(["word"] * random.randint(1, 4 * 75))}
+			for i in range(64)
+		]
+	return walker
+
+def is_inverted(walker):
+	# Whether any caption of the first bucket is sorted after a shorter one
+	chunks = [walker.get_token_chunks(item) for item in walker.final_dataset[:64]]
+	return any(a > b for a, b in zip(chunks, chunks[1:]))
+
+def test_grouping_reduces_padding():
+	ungrouped = build_walker(0)
+	ungrouped.bucketize(8)
+	strict = build_walker(0)
+	strict.bucketize(8, group_by_tokens=True, token_randomness=0.0)
+	noisy = build_walker(0)
+	noisy.bucketize(8, group_by_tokens=True)
+
+	baseline = ungrouped.get_padding_fraction(8)
+	assert strict.get_padding_fraction(8) < noisy.get_padding_fraction(8) < baseline
+
+def test_noise_swaps_neighbouring_chunk_counts():
+	strict = build_walker(1)
+	strict.bucketize(8, group_by_tokens=True, token_randomness=1.0)
+	assert not is_inverted(strict)
+	noisy = build_walker(1)
+	noisy.bucketize(8, group_by_tokens=True, token_randomness=2.0)
+	assert is_inverted(noisy)
@@ -0,0 +1,37 @@
+import torch
+import pytest
+from gdf_util import GDF, EpsilonTarget, CosineSchedule, VPScaler, CosineTNoiseCond, P2LossWeight, DDIMSampler, DPMSolverMultistepSampler, UniPCSampler
+from benchmark_util import GaussianDenoiser
+
+MEAN, STD = 0.5, 0.5
+
+def make_gdf():
+	return GDF(
+		schedule=CosineSchedule(clamp_range=[0.0001, 0.9999]),
+		input_scaler=VPScaler(), target=EpsilonTarget(),
+		noise_cond=CosineTNoiseCond(),
+		loss_weight=P2LossWeight(),
+	)
+
+def sampling_error(gdf, sampler, timesteps, x_init):
+	# RMS distance of the last x0 prediction to the exact posterior mean at the same point of the ODE.
+	# For x0 ~ N(MEAN, STD^2) the probability flow is affine, x_t = a * MEAN + sqrt(a^2 STD^2 + b^2) * z for a fixed z
+	x0 = None
+	for x0, x, pred in gdf.sample(GaussianDenoiser(gdf, MEAN, STD), {}, x_init.shape, x_init=x_init, sampler=sampler, timesteps=timesteps, cfg=None):
+		pass
+	logSNR = gdf.schedule(torch.linspace(1.0, 0.0, timesteps + 1))
+	a_start, b_start = gdf.input_scaler(logSNR[0])
+	z = (x_init - a_start * MEAN) / (a_start ** 2 * STD ** 2 + b_start ** 2).sqrt()
+	a, b = gdf.input_scaler(logSNR[timesteps - 1])
+	posterior_mean = MEAN + a * STD ** 2 * z / (a ** 2 * STD ** 2 + b ** 2).sqrt()
+	return (x0 - posterior_mean).pow(2).mean().sqrt().item()
+
+@pytest.mark.parametrize("sampler_fn", [DPMSolverMultistepSampler, UniPCSampler])
+@pytest.mark.parametrize("timesteps", [10, 20])
+def test_multistep_samplers_reach_posterior_mean(sampler_fn, timesteps):
+	gdf = make_gdf()
+	x_init = torch.randn(2, 4, 8, 8, generator=torch.Generator().manual_seed(0))
+	error = sampling_error(gdf, sampler_fn(gdf), timesteps, x_init)
+	ddim_error = sampling_error(gdf, DDIMSampler(gdf), timesteps, x_init)
+	assert error < 0.02
+	assert error < 0.5 * ddim_error
@@ -0,0 +1,154 @@
+import pytest
+import torch
+from torch import nn
+from model_util import ResBlock, AttnBlock, TimestepBlock, ControlNetDeliverer, CondCachedStageC, DeepCachedStageC, stage_c_inputs
+from gdf_util import DDIMSampler
+from benchmark_util import tiny_stage_c
+from test_gdf_util import make_gdf
+
+# The per block dispatch StageC ran before the execution plan, kept as the reference
+
+def reference_block(block, x, r_embed, clip, cnet, skip=None, is_up=False):
+	if isinstance(block, ResBlock):
+		if cnet is not None:
+			next_cnet = cnet()
+			if next_cnet is not None:
+				x = x + nn.functional.interpolate(next_cnet, size=x.shape[-2:], mode='bilinear', align_corners=True)
+		return block(x, skip) if is_up else block(x)
+	elif isinstance(block, AttnBlock):
+		return block(x, clip)
+	elif isinstance(block, TimestepBlock):
+		return block(x, r_embed)
+	return block(x)
+
+def reference_forward(model, x, r, clip_text, clip_text_pooled, clip_img, cnet=None):
+	r_embed = model.gen_r_embedding(r)
+	for c in model.t_conds:
+		r_embed = torch.cat([r_embed, model.gen_r_embedding(torch.zeros_like(r))], dim=1)
+	clip = model.gen_c_embeddings(clip_text, clip_text_pooled, clip_img)
+	x = model.embedding(x)
+	if cnet is not None:
+		cnet = ControlNetDeliverer(cnet)
+
+	level_outputs = []
+	for down_block, downscaler, repmap in zip(model.down_blocks, model.down_downscalers, model.down_repeat_mappers):
+		x = downscaler(x)
+		for i in range(len(repmap) + 1):
+			for block in down_block:
+				x = reference_block(block, x, r_embed, clip, cnet)
+			if i < len(repmap):
+				x = repmap[i](x)
+		level_outputs.insert(0, x)
+
+	x = level_outputs[0]
+	for i, (up_block, upscaler, repmap) in enumerate(zip(model.up_blocks, model.up_upscalers, model.up_repeat_mappers)):
+		for j in range(len(repmap) + 1):
+			for k, block in enumerate(up_block):
+				skip = None
+				if isinstance(block, ResBlock):
+					skip = level_outputs[i] if k == 0 and i > 0 else None
+					if skip is not None and (x.size(-1) != skip.size(-1) or x.size(-2) != skip.size(-2)):
+						x = nn.functional.interpolate(x.float(), skip.shape[-2:], mode='bilinear', align_corners=True)
+				x = reference_block(block, x, r_embed, clip, cnet, skip, is_up=True)
+			if j < len(repmap):
+				x = repmap[j](x)
+		x = upscaler(x)
+	return model.clf(x)
+
+@pytest.mark.parametrize("config", [
+	{},
+	{"block_repeat": [[2, 1], [1, 2]]},
+	# Odd latent sizes don't survive the down and up resampling, the skip connection resizes
+	{"switch_level": [True]},
+])
+@pytest.mark.parametrize("with_cnet", [False, True])
+def test_execution_plan_matches_block_dispatch(config, with_cnet):
+	torch.manual_seed(0)
+	model = tiny_stage_c(**config)
+	inputs = stage_c_inputs(model, batch_size=2, shape=(16, 13, 11), n_chunks=2)
+	cnet = None
+	if with_cnet:
+		c_hidden = model.embedding[1].out_channels
+		cnet = [torch.randn(2, c_hidden, 7, 5), None, torch.randn(2, c_hidden, 13, 11), torch.randn(2, c_hidden, 4, 4)]
+
+	with torch.no_grad():
+		expected = reference_forward(model, **inputs, cnet=cnet)
+		output = model(**inputs, cnet=cnet)
+	assert torch.allclose(output, expected, atol=1e-5, rtol=1e-5)
+
+def test_cond_cache_matches_plain_forward():
+	torch.manual_seed(0)
+	model = tiny_stage_c()
+	cached = CondCachedStageC(model)
+	inputs = stage_c_inputs(model, batch_size=2, shape=(16, 8, 8), n_chunks=2)
+	other = stage_c_inputs(model, batch_size=2, shape=(16, 8, 8), n_chunks=2)
+
+	with torch.no_grad():
+		assert torch.allclose(cached(**inputs), model(**inputs), atol=1e-5, rtol=1e-5)
+		cond_cache = cached.cond_cache
+		# A new step with the same conditioning tensors reuses the cache
+		next_step = inputs | {"x": other["x"], "r": other["r"]}
+		assert torch.allclose(cached(**next_step), model(**next_step), atol=1e-5, rtol=1e-5)
+		assert cached.cond_cache is cond_cache
+		# New conditioning rebuilds it
+		assert torch.allclose(cached(**other), model(**other), atol=1e-5, rtol=1e-5)
+		assert cached.cond_cache is not cond_cache
+
+class DeepCacheRecorder():
+	# Records whether each step ran the deep levels
+	def __init__(self, model):
+		self.model = model
+		self.refreshed = []
+
+	def __call__(self, *args, deep_cache=None, **kwargs):
+		self.refreshed.append(deep_cache.features is None)
+		return self.model(*args, deep_cache=deep_cache, **kwargs)
+
+def test_deep_cache_refresh_matches_full_forward():
+	torch.manual_seed(0)
+	model = tiny_stage_c()
+	deep_cached = DeepCachedStageC(model, interval=3)
+	inputs = stage_c_inputs(model, batch_size=2, shape=(16, 8, 8))
+	with torch.no_grad():
+		expected = model(**inputs)
+		assert torch.equal(deep_cached(**inputs), expected)
+		assert deep_cached.cache.features is not None
+		for r in [0.8, 0.6]:
+			step_inputs = inputs | {"x": torch.randn_like(inputs["x"]), "r": torch.full_like(inputs["r"], r)}
+			assert deep_cached(**step_inputs).shape == expected.shape
+
+def test_deep_cache_interval_across_sample_calls():
+	gdf = make_gdf()
+	model = tiny_stage_c()
+	recorder = DeepCacheRecorder(model)
+	deep_cached = DeepCachedStageC(recorder, interval=3)
+	inputs = stage_c_inputs(model, batch_size=1, shape=(16, 8, 8))
+	model_inputs = {k: inputs[k] for k in ["clip_text", "clip_text_pooled", "clip_img"]}
+	with torch.no_grad():
+		for _ in range(2):
+			for _ in gdf.sample(deep_cached, model_inputs, inputs["x"].shape, timesteps=5, cfg=None, sampler=DDIMSampler(gdf)):
+				pass
+		# A new sample() call starts over on a refresh step
+		assert recorder.refreshed == [True, False, False, True, False] * 2
+		# So does a new shape
+		recorder.refreshed = []
+		deep_cached(**stage_c_inputs(model, batch_size=1, shape=(16, 6, 6)) | {"r": torch.zeros(1)})
+		deep_cached(**stage_c_inputs(model, batch_size=1, shape=(16, 8, 8)) | {"r": torch.zeros(1) - 1})
+		deep_cached.reset()
+		deep_cached(**inputs)
+		assert recorder.refreshed == [True, True, True]
+
+@pytest.mark.parametrize("config", [{}, {"switch_level": [True]}])
+def test_channels_last_matches_contiguous(config):
+	torch.manual_seed(0)
+	model = tiny_stage_c(**config)
+	inputs = stage_c_inputs(model, batch_size=2, shape=(16, 13, 11), n_chunks=2)
+	with torch.no_grad():
+		expected = model(**inputs)
+		model.set_channels_last()
+		output = model(**inputs)
+		# Switching back restores the contiguous forward
+		model.set_channels_last(False)
+		assert torch.equal(model(**inputs), expected)
+	assert output.is_contiguous()
+	assert torch.allclose(output, expected, atol=1e-5, rtol=1e-5)
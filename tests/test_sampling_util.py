@@ -0,0 +1,80 @@
+import torch
+from types import SimpleNamespace
+from gdf_util import DDIMSampler
+from sampling_util import SamplingEngine, SampleRequest
+from benchmark_util import GaussianDenoiser
+from test_gdf_util import make_gdf
+
+C, C_IMG = 8, 4
+SHAPE = (4, 6, 6)
+
+class FakeTokenizer():
+	# One token per word
+	model_max_length = 77
+
+	def __call__(self, prompt, padding=None, verbose=False):
+		return SimpleNamespace(input_ids=prompt.split())
+
+class FakePromptCache():
+	# Embeddings only depend on the prompt, padded with a constant chunk to the longest prompt of the call
+	tokenizer = FakeTokenizer()
+
+	def embed(self, prompt):
+		n_chunks = max(1, -(-len(prompt.split()) // 75))
+		if prompt == "":
+			return torch.zeros(77, C), torch.zeros(1, C)
+		generator = torch.Generator().manual_seed(sum(map(ord, prompt)))
+		return torch.randn(77 * n_chunks, C, generator=generator), torch.randn(n_chunks, C, generator=generator)
+
+	def __call__(self, prompts, device="cpu"):
+		entries = [self.embed(prompt) for prompt in prompts]
+		n_chunks = max(pool.shape[0] for text, pool in entries)
+		clip_text = torch.stack([torch.cat([text, torch.full((77 * (n_chunks - pool.shape[0]), C), 0.1)]) for text, pool in entries])
+		clip_text_pooled = torch.stack([torch.cat([pool, torch.full((n_chunks - pool.shape[0], C), 0.1)]) for text, pool in entries])
+		return clip_text.to(device), clip_text_pooled.to(device)
+
+class PromptDenoiser():
+	# GaussianDenoiser whose mean depends on the conditioning, padding chunks included
+	def __init__(self, gdf):
+		self.gdf = gdf
+
+	def build_cond_cache(self, clip_text, clip_text_pooled, clip_img):
+		return None
+
+	def __call__(self, x, r, clip_text, clip_text_pooled, clip_img, cond_cache=None):
+		mean = 0.5 + 0.5 * clip_text_pooled.mean(dim=[1, 2]) + 0.1 * clip_text.mean(dim=[1, 2])
+		return GaussianDenoiser(self.gdf, mean.view(-1, 1, 1, 1), 0.5)(x, r)
+
+def reference_sample(gdf, model, prompt_cache, request, timesteps, cfg_rho):
+	# One request at a time through GDF.sample
+	clip_text, clip_text_pooled = prompt_cache([request.prompt, ""])
+	clip_img = torch.zeros(1, 1, C_IMG)
+	model_inputs = {"clip_text": clip_text[:1], "clip_text_pooled": clip_text_pooled[:1], "clip_img": clip_img}
+	unconditional_inputs = {"clip_text": clip_text[1:], "clip_text_pooled": clip_text_pooled[1:], "clip_img": clip_img}
+	x_init = torch.randn(*SHAPE, generator=torch.Generator().manual_seed(request.seed))[None]
+	for x0, x, pred in gdf.sample(
+		model, model_inputs, x_init.shape, unconditional_inputs=unconditional_inputs, sampler=DDIMSampler(gdf),
+		timesteps=timesteps, x_init=x_init, cfg=request.cfg, cfg_rho=cfg_rho
+	):
+		pass
+	return x0[0]
+
+def test_batched_sampling_matches_one_at_a_time():
+	gdf = make_gdf()
+	model = PromptDenoiser(gdf)
+	prompt_cache = FakePromptCache()
+	long_prompt = " ".join(["word"] * 100)
+	requests = [
+		SampleRequest("a cat", 0, 4.0),
+		SampleRequest(long_prompt, 1, 2.0),
+		SampleRequest("a dog", 2, 7.0),
+		SampleRequest("a cat", 3, 1.0),
+		SampleRequest(long_prompt + " again", 4, 5.0),
+	]
+	# Two chunk counts, and the short prompts split over two batches
+	engine = SamplingEngine(gdf, model, prompt_cache, max_batch_size=2, c_clip_img=C_IMG)
+	for cfg_rho in [0.0, 0.7]:
+		outputs = engine.sample(requests, SHAPE, timesteps=6, cfg_rho=cfg_rho)
+		for request, output in zip(requests, outputs):
+			expected = reference_sample(gdf, model, prompt_cache, request, 6, cfg_rho)
+			assert torch.allclose(output, expected, atol=1e-5, rtol=1e-5)
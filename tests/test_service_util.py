@@ -0,0 +1,59 @@
+import os
+import stat
+import shutil
+import tempfile
+import pytest
+import torch
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+from service_util import EncoderService, EncoderClient, LocalEncoderClient, authkey_path
+
+C = 8
+
+def fake_encode_text(tokens, att_mask, batch_size, dropout):
+	# Deterministic stand-in for text_cache, (B, 77 * chunks, C) and (B, chunks, C)
+	if dropout:
+		return torch.zeros(batch_size, 77, C), torch.zeros(batch_size, 1, C)
+	embeddings = [(chunk * mask).float()[..., None] * torch.arange(1, C + 1).float() for chunk, mask in zip(tokens, att_mask)]
+	return torch.cat(embeddings, dim=1), torch.stack([embedding[:, -1] for embedding in embeddings], dim=1)
+
+def fake_encode_image(images):
+	return images.flatten(1).mean(dim=1, keepdim=True) * torch.arange(1, C + 1).float()
+
+@pytest.fixture
+def service():
+	# A short directory, AF_UNIX addresses are limited to about 100 characters
+	directory = tempfile.mkdtemp()
+	service = EncoderService(os.path.join(directory, "encoders.sock"), fake_encode_text, fake_encode_image, batch_window=0.001).start()
+	yield service
+	service.close()
+	shutil.rmtree(directory)
+
+def test_service_matches_local_client(service):
+	client = EncoderClient(service.address, timeout=5)
+	local = LocalEncoderClient(fake_encode_text, fake_encode_image)
+	generator = torch.Generator().manual_seed(0)
+
+	for n_chunks in [1, 2]:
+		tokens = [torch.randint(0, 1000, (3, 77), generator=generator) for _ in range(n_chunks)]
+		att_mask = [torch.ones(3, 77, dtype=torch.long) for _ in range(n_chunks)]
+		remote = client.encode_text(tokens, att_mask, 3)
+		expected = local.encode_text(tokens, att_mask, 3)
+		assert len(remote) == len(expected)
+		for a, b in zip(remote, expected):
+			assert torch.equal(a, b)
+
+	remote = client.encode_text([], [], 2, dropout=True)
+	expected = local.encode_text([], [], 2, dropout=True)
+	for a, b in zip(remote, expected):
+		assert torch.equal(a, b)
+
+	images = torch.rand(2, 3, 16, 16, generator=generator)
+	assert torch.equal(client.encode_image(images), local.encode_image(images))
+	client.close()
+
+def test_service_requires_authkey(service):
+	assert stat.S_IMODE(os.stat(service.address).st_mode) == 0o600
+	assert stat.S_IMODE(os.stat(authkey_path(service.address)).st_mode) == 0o600
+	with pytest.raises(AuthenticationError):
+		Client(service.address, family="AF_UNIX", authkey=b"wrong key")
@@ -0,0 +1,142 @@
+import math
+import pytest
+import torch
+from torch import nn
+from types import SimpleNamespace
+from text_util import text_cache, chunk_tokens, encode_padding_chunk, apply_caption_dropout, TextEmbeddingStore
+
+C = 16
+SETTINGS = {"max_token_limit": 225, "clip_skip": -1}
+
+class FakeTokenizer():
+	model_max_length = 77
+	bos_token_id = 998
+	eos_token_id = 999
+	pad_token_id = 0
+
+	def pad(self, encoded, padding, max_length, return_tensors):
+		input_ids = torch.full((len(encoded["input_ids"]), max_length), self.pad_token_id)
+		attention_mask = torch.zeros_like(input_ids)
+		for i, tokens in enumerate(encoded["input_ids"]):
+			input_ids[i, :len(tokens)] = torch.tensor(tokens)
+			attention_mask[i, :len(tokens)] = 1
+		return FakeEncoding(input_ids=input_ids, attention_mask=attention_mask)
+
+class FakeEncoding(dict):
+	def to(self, device):
+		return FakeEncoding({k: v.to(device) for k, v in self.items()})
+
+class FakeOutput(dict):
+	__getattr__ = dict.__getitem__
+
+class FakeCLIP(nn.Module):
+	# Mixes tokens along the sequence under the attention mask like the real encoder, rows never interact
+	def __init__(self):
+		super().__init__()
+		self.embedding = nn.Embedding(1000, C)
+		self.projection = nn.Linear(C, C)
+
+	def forward(self, input_ids, attention_mask, output_hidden_states=True):
+		mask = attention_mask[..., None].float()
+		tokens = self.embedding(input_ids)
+		mixed = (tokens * mask).cumsum(dim=1) / (mask.cumsum(dim=1) + 1) + tokens
+		return FakeOutput(hidden_states=(tokens, mixed), text_embeds=self.projection(mixed[:, -1]))
+
+def reference_text_cache(text_model, captions, att_mask, tokenizer, settings):
+	# The per chunk loop text_cache ran before all chunks shared one forward
+	token_chunks_limit = max(1, math.ceil(settings["max_token_limit"] / (tokenizer.model_max_length - 2)))
+	text_embeddings = None
+	text_embeddings_pool = None
+	for chunk_id in range(len(captions)):
+		if chunk_id > token_chunks_limit:
+			break
+		token_chunk = captions[chunk_id]
+		token_chunk = torch.cat((torch.full((token_chunk.shape[0], 1), tokenizer.bos_token_id), token_chunk, torch.full((token_chunk.shape[0], 1), tokenizer.eos_token_id)), 1)
+		attn_chunk = att_mask[chunk_id]
+		bos_mask = 1 if chunk_id == 0 else 0
+		attn_chunk = torch.cat((torch.full((attn_chunk.shape[0], 1), bos_mask), attn_chunk, torch.full((attn_chunk.shape[0], 1), 0)), 1)
+		output = text_model(input_ids=token_chunk, attention_mask=attn_chunk, output_hidden_states=True)
+		if text_embeddings is None:
+			text_embeddings = output["hidden_states"][settings["clip_skip"]]
+			text_embeddings_pool = output.text_embeds.unsqueeze(1)
+		else:
+			text_embeddings = torch.cat((text_embeddings, output["hidden_states"][settings["clip_skip"]]), dim=-2)
+			text_embeddings_pool = torch.cat((text_embeddings_pool, output.text_embeds.unsqueeze(1)), dim=-2)
+	return text_embeddings, text_embeddings_pool
+
+def make_chunks(lengths, n_chunks, generator):
+	# Captions of different lengths padded out to the batch's chunk count, as chunk_tokens produces them
+	tokens = torch.randint(0, 990, (len(lengths), n_chunks * 75), generator=generator)
+	mask = torch.zeros_like(tokens)
+	for i, length in enumerate(lengths):
+		mask[i, :length] = 1
+	tokens = torch.where(mask.bool(), tokens, torch.zeros_like(tokens))
+	return list(tokens.split(75, dim=1)), list(mask.split(75, dim=1))
+
+# The last case has more chunks than max_token_limit allows and is cut off the same way
+@pytest.mark.parametrize("lengths,n_chunks", [([30, 75], 1), ([10, 140, 90], 2), ([200, 20, 160, 75], 3), ([370, 5], 5)])
+def test_batched_text_cache_matches_per_chunk(lengths, n_chunks):
+	torch.manual_seed(0)
+	text_model = FakeCLIP().eval()
+	captions, att_mask = make_chunks(lengths, n_chunks, torch.Generator().manual_seed(1))
+	accelerator = SimpleNamespace(device=torch.device("cpu"))
+	with torch.no_grad():
+		text_embeddings, text_embeddings_pool = text_cache(False, text_model, accelerator, captions, att_mask, FakeTokenizer(), SETTINGS, len(lengths))
+		expected, expected_pool = reference_text_cache(text_model, captions, att_mask, FakeTokenizer(), SETTINGS)
+	assert text_embeddings.shape == expected.shape
+	assert text_embeddings_pool.shape == expected_pool.shape
+	assert torch.allclose(text_embeddings, expected, atol=1e-6)
+	assert torch.allclose(text_embeddings_pool, expected_pool, atol=1e-6)
+
+def make_encode_fn(text_model):
+	accelerator = SimpleNamespace(device=torch.device("cpu"))
+	def encode_fn(tokens, att_mask, batch_size, dropout=False):
+		return text_cache(dropout, text_model, accelerator, tokens, att_mask, FakeTokenizer(), SETTINGS, batch_size)
+	return encode_fn
+
+def make_captions(lengths, generator):
+	return [torch.randint(1, 990, (length,), generator=generator).tolist() for length in lengths]
+
+def test_text_store_round_trip_matches_batch_encoding(tmp_path):
+	torch.manual_seed(0)
+	encode_fn = make_encode_fn(FakeCLIP().eval())
+	captions = make_captions([30, 140, 200, 75, 10], torch.Generator().manual_seed(1))
+	store = TextEmbeddingStore(str(tmp_path), FakeTokenizer(), "fake-clip", encode_fn=encode_fn)
+	# Entries don't depend on the batch they were encoded in, the first two are encoded with fewer chunks
+	store.encode(captions[:2])
+	keys = store.encode(captions)
+	assert store.misses == 5 and store.hits == 2
+
+	for batch in [captions, captions[:2], captions[3:]]:
+		batch_keys = [keys[captions.index(caption)] for caption in batch]
+		text_embeddings, text_embeddings_pool = store.load(batch_keys)
+		with torch.no_grad():
+			expected, expected_pool = encode_fn(*chunk_tokens(batch, FakeTokenizer(), "cpu"), len(batch))
+		assert text_embeddings.shape == expected.shape
+		assert text_embeddings_pool.shape == expected_pool.shape
+		assert torch.allclose(text_embeddings, expected, atol=1e-6)
+		assert torch.allclose(text_embeddings_pool, expected_pool, atol=1e-6)
+
+@pytest.mark.parametrize("lengths", [[30, 140, 200], [30, 60, 10]])
+def test_caption_dropout_pads_dropped_rows(lengths):
+	torch.manual_seed(0)
+	encode_fn = make_encode_fn(FakeCLIP().eval())
+	captions = make_captions(lengths, torch.Generator().manual_seed(1))
+	with torch.no_grad():
+		text_embeddings, text_embeddings_pool = encode_fn(*chunk_tokens(captions, FakeTokenizer(), "cpu"), len(captions))
+		padding = encode_padding_chunk(encode_fn, FakeTokenizer())
+	te_dropout, pool_dropout = torch.randn(1, 77, C), torch.randn(1, 1, C)
+	mask = torch.tensor([True, False, True])
+
+	dropped, dropped_pool = apply_caption_dropout(text_embeddings, text_embeddings_pool, mask, te_dropout, pool_dropout, padding)
+	n_chunks = text_embeddings_pool.shape[1]
+	assert dropped.shape == text_embeddings.shape and dropped_pool.shape == text_embeddings_pool.shape
+	expected = torch.cat([te_dropout[0]] + [padding["text_cache"]] * (n_chunks - 1))
+	expected_pool = torch.cat([pool_dropout[0]] + [padding["pool_cache"]] * (n_chunks - 1))
+	for i in range(len(captions)):
+		if mask[i]:
+			assert torch.equal(dropped[i], expected)
+			assert torch.equal(dropped_pool[i], expected_pool)
+		else:
+			assert torch.equal(dropped[i], text_embeddings[i])
+			assert torch.equal(dropped_pool[i], text_embeddings_pool[i])
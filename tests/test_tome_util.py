@@ -0,0 +1,45 @@
+import pytest
+import torch
+from tome_util import bipartite_soft_matching, do_nothing
+from model_util import stage_c_inputs
+from benchmark_util import tiny_stage_c
+
+def test_ratio_zero_is_identity():
+	x = torch.randn(2, 12, 8)
+	merge, unmerge = bipartite_soft_matching(x, 0)
+	assert merge is do_nothing and unmerge is do_nothing
+
+	torch.manual_seed(0)
+	model = tiny_stage_c()
+	inputs = stage_c_inputs(model, batch_size=2, shape=(16, 8, 8))
+	with torch.no_grad():
+		expected = model(**inputs)
+		model.set_token_merging(0.0)
+		assert torch.equal(model(**inputs), expected)
+
+@pytest.mark.parametrize("n_tokens", [12, 13])
+@pytest.mark.parametrize("r", [1, 4, 6])
+def test_unmerge_restores_unmerged_tokens(n_tokens, r):
+	generator = torch.Generator().manual_seed(0)
+	x = torch.randn(2, n_tokens, 8, generator=generator)
+	merge, unmerge = bipartite_soft_matching(x, r)
+	merged = merge(x)
+	assert merged.shape == (2, n_tokens - r, 8)
+	restored = unmerge(merged)
+	assert restored.shape == x.shape
+
+	# Only the r merged even tokens and the odd tokens they were merged into change, everything else is back in place
+	unchanged = (restored == x).all(dim=-1)
+	assert ((~unchanged[:, ::2]).sum(dim=-1) <= r).all()
+	assert ((~unchanged[:, 1::2]).sum(dim=-1) <= r).all()
+	# Every even token either stays where it was or takes the value of the odd token it was merged into
+	for batch in range(2):
+		for i in range(0, n_tokens, 2):
+			if not unchanged[batch, i]:
+				assert any(torch.equal(restored[batch, i], restored[batch, j]) for j in range(1, n_tokens, 2))
+
+def test_unmerge_of_identical_tokens_is_exact():
+	# Merging tokens with the same value averages nothing away, so merge then unmerge gives the input back
+	x = torch.randn(2, 6, 8).repeat_interleave(2, dim=1)
+	merge, unmerge = bipartite_soft_matching(x, 6)
+	assert torch.equal(unmerge(merge(x)), x)
@@ -0,0 +1,62 @@
+import torch
+from torch import nn
+from xformers_util import Attention, FlashAttention2D
+from model_util import Attention2D
+
+C, NHEAD = 16, 2
+
+def old_layout_state_dict(prefix=""):
+	# Separate to_q/to_k/to_v projections, as checkpoints were saved before the fused in projection
+	generator = torch.Generator().manual_seed(0)
+	state_dict = {}
+	for name in ["to_q", "to_k", "to_v", "out_proj"]:
+		state_dict[f"{prefix}{name}.weight"] = torch.randn(C, C, generator=generator) * C ** -0.5
+		state_dict[f"{prefix}{name}.bias"] = torch.randn(C, generator=generator)
+	return state_dict
+
+def reference_mha(state_dict, prefix=""):
+	mha = nn.MultiheadAttention(C, NHEAD, bias=True, batch_first=True)
+	mha.load_state_dict({
+		"in_proj_weight": torch.cat([state_dict[f"{prefix}to_{p}.weight"] for p in "qkv"]),
+		"in_proj_bias": torch.cat([state_dict[f"{prefix}to_{p}.bias"] for p in "qkv"]),
+		"out_proj.weight": state_dict[f"{prefix}out_proj.weight"],
+		"out_proj.bias": state_dict[f"{prefix}out_proj.bias"],
+	})
+	return mha.eval()
+
+def sdpa_heads(q, k, v):
+	# Stands in for xformers' memory_efficient_attention on CPU, same [B, tokens, heads, head_dim] layout
+	return nn.functional.scaled_dot_product_attention(*[t.transpose(1, 2) for t in (q, k, v)]).transpose(1, 2)
+
+def test_fused_attention_loads_old_layout(monkeypatch):
+	state_dict = old_layout_state_dict()
+	mha = reference_mha(state_dict)
+	attention = Attention(C, NHEAD)
+	attention.load_state_dict(dict(state_dict))
+	monkeypatch.setattr(attention, "forward_memory_efficient_xformers", sdpa_heads)
+
+	x, kv = torch.randn(2, 12, C), torch.randn(2, 5, C)
+	with torch.no_grad():
+		q = attention.to_q(x)
+		k, v = attention.to_kv(kv)
+		assert torch.equal(q, nn.functional.linear(x, state_dict["to_q.weight"], state_dict["to_q.bias"]))
+		assert torch.equal(k, nn.functional.linear(kv, state_dict["to_k.weight"], state_dict["to_k.bias"]))
+		assert torch.equal(v, nn.functional.linear(kv, state_dict["to_v.weight"], state_dict["to_v.bias"]))
+		assert torch.allclose(attention(x, kv, kv), mha(x, kv, kv, need_weights=False)[0], atol=1e-5, rtol=1e-5)
+
+def test_flash_attention_2d_and_attention_2d_load_old_layout(monkeypatch):
+	# FlashAttention2D checkpoints load into both modules, flash_attention now builds Attention2D on the xformers backend
+	state_dict = old_layout_state_dict("attn.")
+	flash = FlashAttention2D(C, NHEAD)
+	flash.load_state_dict(dict(state_dict))
+	monkeypatch.setattr(flash.attn, "forward_memory_efficient_xformers", sdpa_heads)
+	attention = Attention2D(C, NHEAD, backend="sdpa").eval()
+	attention.load_state_dict(dict(state_dict))
+	mha = Attention2D(C, NHEAD).eval()
+	mha.attn = reference_mha(state_dict, "attn.")
+
+	x, kv = torch.randn(2, C, 3, 4), torch.randn(2, 5, C)
+	with torch.no_grad():
+		expected = mha(x, kv, self_attn=True)
+		assert torch.allclose(flash(x, kv, self_attn=True), expected, atol=1e-5, rtol=1e-5)
+		assert torch.allclose(attention(x, kv, self_attn=True), expected, atol=1e-5, rtol=1e-5)
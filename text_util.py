@@ -0,0 +1,429 @@
+# Text encoder helpers for Stable Cascade training
+
+import os
+import math
+import queue
+import hashlib
+import threading
+import torch
+import numpy as np
+from collections import OrderedDict
+
+def chunk_tokens(raw_tokens, tokenizer, device):
+	# Get total number of chunks
+	max_len = max(len(x) for x in raw_tokens)
+	num_chunks = math.ceil(max_len / (tokenizer.model_max_length - 2))
+	if num_chunks < 1:
+		num_chunks = 1
+
+	# Get the true padded length of the tokens
+	len_input = tokenizer.model_max_length - 2
+	if num_chunks > 1:
+		len_input = (tokenizer.model_max_length * num_chunks) - (num_chunks * 2)
+
+	# Tokenize!
+	tokens = tokenizer.pad(
+		{"input_ids": raw_tokens},
+		padding="max_length",
+		max_length=len_input,
+		return_tensors="pt"
+	).to(device)
+	batch_tokens = tokens["input_ids"].to(device)
+	batch_att_mask = tokens["attention_mask"].to(device)
+
+	max_standard_tokens = tokenizer.model_max_length - 2
+	true_len = max(len(x) for x in batch_tokens)
+	n_chunks = np.ceil(true_len / max_standard_tokens).astype(int)
+	max_len = n_chunks.item() * max_standard_tokens
+
+	cropped_tokens = [batch_tokens[:, i:i + max_standard_tokens] for i in range(0, max_len, max_standard_tokens)]
+	cropped_attn = [batch_att_mask[:, i:i + max_standard_tokens] for i in range(0, max_len, max_standard_tokens)]
+	return cropped_tokens, cropped_attn
+
+chunk_templates = {}
+
+def get_chunk_templates(tokenizer, n_chunks, batch_size, device):
+	# BOS/EOS columns and their attention mask for k chunks of a batch, built once per shape
+	key = (tokenizer.bos_token_id, tokenizer.eos_token_id, n_chunks, batch_size, str(device))
+	if key not in chunk_templates:
+		rows = n_chunks * batch_size
+		bos = torch.full((rows, 1), tokenizer.bos_token_id, dtype=torch.long, device=device)
+		eos = torch.full((rows, 1), tokenizer.eos_token_id, dtype=torch.long, device=device)
+		# First 75 tokens we allow BOS to not be masked - otherwise we mask them out
+		bos_mask = torch.zeros((rows, 1), dtype=torch.long, device=device)
+		bos_mask[:batch_size] = 1
+		eos_mask = torch.zeros((rows, 1), dtype=torch.long, device=device)
+		chunk_templates[key] = (bos, eos, bos_mask, eos_mask)
+	return chunk_templates[key]
+
+def max_token_chunks(max_token_limit, max_length=77):
+	# Most chunks text_cache encodes for one caption, the limit rounded up plus one for captions that overshoot it
+	return max(1, math.ceil(max_token_limit / (max_length - 2))) + 1
+
+def text_cache(dropout, text_model, accelerator, captions, att_mask, tokenizer, settings, batch_size):
+	text_embeddings = None
+	text_embeddings_pool = None
+
+	if dropout:
+		captions_unpooled = ["" for _ in range(batch_size)]
+		clip_tokens_unpooled = tokenizer(captions_unpooled, truncation=True, padding="max_length",
+										max_length=tokenizer.model_max_length,
+										return_tensors="pt").to(accelerator.device)
+
+		text_encoder_output = text_model(**clip_tokens_unpooled, output_hidden_states=True)
+		text_embeddings = text_encoder_output.hidden_states[settings["clip_skip"]]
+		text_embeddings_pool = text_encoder_output.text_embeds.unsqueeze(1)
+	else:
+		# Hard limit the tokens to fit in memory for the rare event that latent caches that somehow exceed the limit.
+		n_chunks = min(len(captions), max_token_chunks(settings["max_token_limit"], tokenizer.model_max_length))
+		batch_size = captions[0].shape[0]
+
+		# Fold the chunks into the batch dimension (chunk major) so every chunk is encoded in a single forward
+		token_chunks = torch.cat([chunk.to(accelerator.device) for chunk in captions[:n_chunks]], dim=0)
+		attn_chunks = torch.cat([chunk.to(accelerator.device) for chunk in att_mask[:n_chunks]], dim=0)
+		bos, eos, bos_mask, eos_mask = get_chunk_templates(tokenizer, n_chunks, batch_size, accelerator.device)
+		token_chunks = torch.cat((bos, token_chunks.to(bos.dtype), eos), 1)
+		attn_chunks = torch.cat((bos_mask, attn_chunks.to(bos_mask.dtype), eos_mask), 1)
+		text_encoder_output = text_model(**{"input_ids": token_chunks, "attention_mask": attn_chunks}, output_hidden_states=True)
+
+		# [k * B, 77, C] -> [B, 77 * k, C] and [k * B, C] -> [B, k, C]
+		hidden_states = text_encoder_output["hidden_states"][settings["clip_skip"]]
+		text_embeddings = hidden_states.view(n_chunks, batch_size, hidden_states.shape[1], hidden_states.shape[2])
+		text_embeddings = text_embeddings.transpose(0, 1).reshape(batch_size, n_chunks * hidden_states.shape[1], hidden_states.shape[2])
+		text_embeddings_pool = text_encoder_output.text_embeds.view(n_chunks, batch_size, -1).transpose(0, 1)
+
+	return text_embeddings, text_embeddings_pool
+
+def encode_padding_chunk(encode_fn, tokenizer):
+	# The encoder output of a fully padded, fully masked chunk is the same for every caption
+	pad_tokens = torch.full((1, tokenizer.model_max_length - 2), tokenizer.pad_token_id)
+	pad_mask = torch.zeros_like(pad_tokens)
+	with torch.no_grad():
+		# The first chunk never masks BOS, so the second chunk is the one that matches batch padding
+		text_embeddings, text_embeddings_pool = encode_fn([pad_tokens, pad_tokens], [pad_mask, pad_mask], 1)
+	return {
+		"text_cache": text_embeddings[0, tokenizer.model_max_length:].detach().clone().cpu(),
+		"pool_cache": text_embeddings_pool[0, 1:].detach().clone().cpu(),
+	}
+
+def apply_caption_dropout(text_embeddings, text_embeddings_pool, mask, dropout_embeddings, dropout_pool, padding):
+	# Swaps the rows selected by mask for the empty prompt, padded out with empty chunks to the batch's chunk count
+	n_chunks = text_embeddings_pool.shape[1]
+	drop_text = dropout_embeddings[:1].to(text_embeddings.device, dtype=text_embeddings.dtype)
+	drop_pool = dropout_pool[:1].to(text_embeddings_pool.device, dtype=text_embeddings_pool.dtype)
+	if n_chunks > 1:
+		pad_text = padding["text_cache"].to(drop_text.device, dtype=drop_text.dtype)
+		pad_pool = padding["pool_cache"].to(drop_pool.device, dtype=drop_pool.dtype)
+		drop_text = torch.cat([drop_text, pad_text.repeat(n_chunks - 1, 1).unsqueeze(0)], dim=1)
+		drop_pool = torch.cat([drop_pool, pad_pool.repeat(n_chunks - 1, 1).unsqueeze(0)], dim=1)
+
+	mask = mask.to(text_embeddings.device)[:, None, None]
+	return torch.where(mask, drop_text, text_embeddings), torch.where(mask, drop_pool, text_embeddings_pool)
+
+def split_chunks(text_embeddings, text_embeddings_pool, raw_tokens, tokenizer):
+	# Every chunk is encoded independently, so the unpadded chunks of each caption can be sliced out of the batch as is
+	entries = []
+	for i, tokens in enumerate(raw_tokens):
+		n_chunks = max(1, math.ceil(len(tokens) / (tokenizer.model_max_length - 2)))
+		n_chunks = min(n_chunks, text_embeddings_pool.shape[1])
+		entries.append({
+			"text_cache": text_embeddings[i, :n_chunks * tokenizer.model_max_length].detach().clone(),
+			"pool_cache": text_embeddings_pool[i, :n_chunks].detach().clone(),
+		})
+	return entries
+
+def stack_chunks(entries, get_padding):
+	# Pads every entry with empty chunks up to the longest one and stacks them into a batch
+	max_chunks = max(entry["pool_cache"].shape[0] for entry in entries)
+
+	text_embeddings = []
+	text_embeddings_pool = []
+	for entry in entries:
+		text, pool = entry["text_cache"], entry["pool_cache"]
+		missing_chunks = max_chunks - pool.shape[0]
+		if missing_chunks > 0:
+			padding = get_padding()
+			text = torch.cat([text, padding["text_cache"].to(text.device, dtype=text.dtype).repeat(missing_chunks, 1)], dim=0)
+			pool = torch.cat([pool, padding["pool_cache"].to(pool.device, dtype=pool.dtype).repeat(missing_chunks, 1)], dim=0)
+		text_embeddings.append(text)
+		text_embeddings_pool.append(pool)
+
+	return torch.stack(text_embeddings), torch.stack(text_embeddings_pool)
+
+# Content addressed store of text encoder outputs.
+# Every unique caption is encoded once and saved as <key>.pt, latent caches only keep the keys.
+class TextEmbeddingStore():
+	def __init__(
+		self,
+		path,
+		tokenizer,
+		model_name,
+		clip_skip=-1,
+		encode_fn=None
+	):
+		# encode_fn(tokens, att_mask, batch_size, dropout=False) -> (text_embeddings, text_embeddings_pool), see text_cache
+		self.path = path
+		self.tokenizer = tokenizer
+		self.model_name = model_name
+		self.clip_skip = clip_skip
+		self.encode_fn = encode_fn
+		self.padding = None
+		self.dropout = None
+		self.hits = 0
+		self.misses = 0
+
+		os.makedirs(self.path, exist_ok=True)
+		self.keys = set(os.path.splitext(f)[0] for f in os.listdir(self.path) if f.endswith(".pt") and f not in ["padding.pt", "dropout.pt"])
+
+	def key(self, tokens):
+		hasher = hashlib.sha1()
+		hasher.update(self.model_name.encode("utf-8"))
+		hasher.update(f"|{self.clip_skip}|".encode("utf-8"))
+		hasher.update(",".join(str(int(t)) for t in tokens).encode("utf-8"))
+		return hasher.hexdigest()
+
+	def get_path(self, key):
+		return os.path.join(self.path, f"{key}.pt")
+
+	def encode(self, raw_tokens):
+		# Returns one key per caption, only encoding captions that have never been seen before
+		keys = [self.key(tokens) for tokens in raw_tokens]
+		missing = {}
+		for key, tokens in zip(keys, raw_tokens):
+			if key in self.keys or key in missing:
+				self.hits += 1
+			else:
+				self.misses += 1
+				missing[key] = tokens
+
+		if len(missing) > 0:
+			if self.encode_fn is None:
+				raise ValueError("TextEmbeddingStore needs an encode_fn to encode new captions.")
+			missing_tokens = list(missing.values())
+			tokens, att_mask = chunk_tokens(missing_tokens, self.tokenizer, "cpu")
+			with torch.no_grad():
+				text_embeddings, text_embeddings_pool = self.encode_fn(tokens, att_mask, len(missing_tokens))
+
+			entries = split_chunks(text_embeddings, text_embeddings_pool, missing_tokens, self.tokenizer)
+			for key, entry in zip(missing.keys(), entries):
+				torch.save({k: v.cpu() for k, v in entry.items()}, self.get_path(key))
+				self.keys.add(key)
+
+		return keys
+
+	def get_padding(self):
+		if self.padding is None:
+			padding_path = os.path.join(self.path, "padding.pt")
+			if os.path.exists(padding_path):
+				self.padding = torch.load(padding_path, map_location="cpu")
+			else:
+				if self.encode_fn is None:
+					raise ValueError("TextEmbeddingStore needs an encode_fn to create the padding chunk.")
+				self.padding = encode_padding_chunk(self.encode_fn, self.tokenizer)
+				torch.save(self.padding, padding_path)
+		return self.padding
+
+	def get_dropout(self):
+		# The empty prompt used for caption dropout, saved so cached runs never need the text model
+		if self.dropout is None:
+			dropout_path = os.path.join(self.path, "dropout.pt")
+			if os.path.exists(dropout_path):
+				self.dropout = torch.load(dropout_path, map_location="cpu")
+			else:
+				if self.encode_fn is None:
+					raise ValueError("TextEmbeddingStore needs an encode_fn to encode the dropout prompt.")
+				with torch.no_grad():
+					text_embeddings, text_embeddings_pool = self.encode_fn([], [], 1, dropout=True)
+				self.dropout = {
+					"text_cache": text_embeddings.detach().clone().cpu(),
+					"pool_cache": text_embeddings_pool.detach().clone().cpu(),
+				}
+				torch.save(self.dropout, dropout_path)
+		return self.dropout["text_cache"], self.dropout["pool_cache"]
+
+	def load(self, keys, device="cpu"):
+		entries = [torch.load(self.get_path(key), map_location="cpu") for key in keys]
+		text_embeddings, text_embeddings_pool = stack_chunks(entries, self.get_padding)
+		return text_embeddings.to(device), text_embeddings_pool.to(device)
+
+	def __len__(self):
+		return len(self.keys)
+
+# Bounded LRU of prompt embeddings for sampling and validation.
+# Fixed evaluation prompts and the empty unconditional prompt are only run through the text model once.
+class PromptEmbeddingCache():
+	def __init__(
+		self,
+		tokenizer,
+		model_name,
+		clip_skip=-1,
+		encode_fn=None,
+		max_entries=256,
+		path=None
+	):
+		# encode_fn(tokens, att_mask, batch_size, dropout=False) -> (text_embeddings, text_embeddings_pool), see text_cache
+		self.tokenizer = tokenizer
+		self.model_name = model_name
+		self.clip_skip = clip_skip
+		self.encode_fn = encode_fn
+		self.max_entries = max_entries
+		self.path = path
+		self.entries = OrderedDict()
+		self.padding = None
+		self.hits = 0
+		self.disk_hits = 0
+		self.misses = 0
+		if self.path is not None:
+			os.makedirs(self.path, exist_ok=True)
+
+	def normalize(self, prompt):
+		return " ".join(prompt.strip().split())
+
+	def key(self, prompt):
+		return (self.model_name, self.clip_skip, self.normalize(prompt))
+
+	def get_path(self, key):
+		hasher = hashlib.sha1()
+		hasher.update("|".join(str(k) for k in key).encode("utf-8"))
+		return os.path.join(self.path, f"{hasher.hexdigest()}.pt")
+
+	def add(self, key, entry):
+		self.entries[key] = entry
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.max_entries:
+			self.entries.popitem(last=False)
+
+	def lookup(self, key, device):
+		if key in self.entries:
+			self.hits += 1
+			self.entries.move_to_end(key)
+			return self.entries[key]
+		if self.path is not None and os.path.exists(self.get_path(key)):
+			self.disk_hits += 1
+			entry = torch.load(self.get_path(key), map_location=device)
+			self.add(key, entry)
+			return entry
+		return None
+
+	def get_padding(self):
+		if self.padding is None:
+			self.padding = encode_padding_chunk(self.encode_fn, self.tokenizer)
+		return self.padding
+
+	def encode(self, prompts, device):
+		# prompts maps key -> normalized prompt for every miss, all of them go through the text model together
+		if self.encode_fn is None:
+			raise ValueError("PromptEmbeddingCache needs an encode_fn to encode new prompts.")
+		entries = {}
+		with torch.no_grad():
+			if "" in prompts.values():
+				# The empty prompt is encoded the way caption dropout does in training
+				text_embeddings, text_embeddings_pool = self.encode_fn([], [], 1, dropout=True)
+				entries.update({key: {
+					"text_cache": text_embeddings[0].detach().clone(),
+					"pool_cache": text_embeddings_pool[0].detach().clone(),
+				} for key, prompt in prompts.items() if prompt == ""})
+
+			keys = [key for key, prompt in prompts.items() if prompt != ""]
+			if len(keys) > 0:
+				raw_tokens = [self.tokenizer(prompts[key], padding="do_not_pad", verbose=False).input_ids for key in keys]
+				tokens, att_mask = chunk_tokens(raw_tokens, self.tokenizer, device)
+				text_embeddings, text_embeddings_pool = self.encode_fn(tokens, att_mask, len(raw_tokens))
+				entries.update(zip(keys, split_chunks(text_embeddings, text_embeddings_pool, raw_tokens, self.tokenizer)))
+
+		for key, entry in entries.items():
+			self.misses += 1
+			entry = {k: v.to(device) for k, v in entry.items()}
+			if self.path is not None:
+				torch.save({k: v.cpu() for k, v in entry.items()}, self.get_path(key))
+			self.add(key, entry)
+			entries[key] = entry
+		return entries
+
+	def __call__(self, prompts, device="cpu"):
+		# Returns (clip_text, clip_text_pooled) for a list of prompts, padded to the longest prompt's chunk count
+		keys = [self.key(prompt) for prompt in prompts]
+		found = {}
+		missing = {}
+		for key in keys:
+			if key in found or key in missing:
+				continue
+			entry = self.lookup(key, device)
+			if entry is None:
+				missing[key] = key[2]
+			else:
+				found[key] = entry
+		if len(missing) > 0:
+			found.update(self.encode(missing, device))
+		return stack_chunks([found[key] for key in keys], self.get_padding)
+
+	def __len__(self):
+		return len(self.entries)
+
+class ConditioningProducer():
+	# Encodes the text of the next batches on a worker thread (and its own CUDA stream) while the current step trains.
+	# Finished embeddings are handed over through a queue as batch["text_embeddings"] and batch["text_embeddings_pool"].
+	def __init__(self, batches, encode_fn, device, ahead=2):
+		# encode_fn(batch) -> (text_embeddings, text_embeddings_pool)
+		self.batches = batches
+		self.encode_fn = encode_fn
+		self.device = torch.device(device)
+		self.ahead = max(1, ahead)
+		self.use_cuda = self.device.type == "cuda"
+
+	def __len__(self):
+		return len(self.batches)
+
+	def put(self, batches, item, stop):
+		while not stop.is_set():
+			try:
+				batches.put(item, timeout=0.1)
+				return True
+			except queue.Full:
+				pass
+		return False
+
+	def work(self, batches, stop):
+		stream = torch.cuda.Stream(device=self.device) if self.use_cuda else None
+		try:
+			# Grad mode is thread local
+			with torch.no_grad():
+				for batch in self.batches:
+					event = None
+					if stream is not None:
+						stream.wait_stream(torch.cuda.current_stream(self.device))
+						with torch.cuda.stream(stream):
+							batch["text_embeddings"], batch["text_embeddings_pool"] = self.encode_fn(batch)
+							event = torch.cuda.Event()
+							event.record(stream)
+					else:
+						batch["text_embeddings"], batch["text_embeddings_pool"] = self.encode_fn(batch)
+					if not self.put(batches, (batch, event), stop):
+						return
+		except Exception as e:
+			self.put(batches, e, stop)
+			return
+		self.put(batches, None, stop)
+
+	def __iter__(self):
+		batches = queue.Queue(maxsize=self.ahead)
+		stop = threading.Event()
+		worker = threading.Thread(target=self.work, args=(batches, stop), daemon=True)
+		worker.start()
+		try:
+			while True:
+				item = batches.get()
+				if item is None:
+					break
+				if isinstance(item, Exception):
+					raise item
+				batch, event = item
+				if event is not None:
+					current = torch.cuda.current_stream(self.device)
+					current.wait_event(event)
+					batch["text_embeddings"].record_stream(current)
+					batch["text_embeddings_pool"].record_stream(current)
+				yield batch
+		finally:
+			stop.set()
+			worker.join()
@@ -0,0 +1,46 @@
+# Token merging (ToMe) for StageC attention
+# Bipartite soft matching merges the most similar image tokens before attention and copies the result back after,
+# see "Token Merging: Your ViT But Faster" (Bolya et al.) and its Stable Diffusion port.
+
+import torch
+
+def do_nothing(x):
+    return x
+
+def bipartite_soft_matching(metric, r):
+    # metric: BxNxC. Returns merge(x) -> Bx(N-r)xC and unmerge(x) -> BxNxC
+    n_tokens = metric.shape[1]
+    r = min(r, n_tokens // 2)
+    if r <= 0:
+        return do_nothing, do_nothing
+
+    with torch.no_grad():
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = metric[..., ::2, :], metric[..., 1::2, :]
+        scores = a @ b.transpose(-1, -2)
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx = edge_idx[..., r:, :]  # tokens of a that stay
+        src_idx = edge_idx[..., :r, :]  # tokens of a merged into b
+        dst_idx = node_idx[..., None].gather(dim=-2, index=src_idx)
+
+    def merge(x):
+        src, dst = x[..., ::2, :], x[..., 1::2, :]
+        n, t1, c = src.shape
+        unm = src.gather(dim=-2, index=unm_idx.expand(n, t1 - r, c))
+        src = src.gather(dim=-2, index=src_idx.expand(n, r, c))
+        dst = dst.scatter_reduce(-2, dst_idx.expand(n, r, c), src, reduce="mean")
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(x):
+        unm_len = unm_idx.shape[1]
+        unm, dst = x[..., :unm_len, :], x[..., unm_len:, :]
+        n, _, c = unm.shape
+        src = dst.gather(dim=-2, index=dst_idx.expand(n, r, c))
+        out = torch.zeros(n, n_tokens, c, device=x.device, dtype=x.dtype)
+        out[..., 1::2, :] = dst
+        out.scatter_(dim=-2, index=(2 * unm_idx).expand(n, unm_len, c), src=unm)
+        out.scatter_(dim=-2, index=(2 * src_idx).expand(n, r, c), src=src)
+        return out
+
+    return merge, unmerge
@@ -8,14 +8,17 @@ import transformers
 
 import sys
 import os
-import math
-import copy
 import random
-from core_util import create_folder_if_necessary, load_or_fail, load_optimizer, save_model, save_optimizer, update_weights_ema
+from core_util import ModelRegistry, create_folder_if_necessary, load_or_fail, load_optimizer, save_model, save_optimizer, update_weights_ema
 from gdf_util import GDF, EpsilonTarget, CosineSchedule, VPScaler, CosineTNoiseCond, DDPMSampler, P2LossWeight, AdaptiveLossWeight
-from model_util import EfficientNetEncoder, StageC, ResBlock, AttnBlock, TimestepBlock, FeedForwardBlock, enable_checkpointing_for_stable_cascade_blocks
+from model_util import EfficientNetEncoder, StageC, ResBlock, AttnBlock, TimestepBlock, FeedForwardBlock, CheckpointPolicy, enable_checkpointing_for_stable_cascade_blocks, stage_c_inputs
 from dataset_util import BucketWalker
-from xformers_util import convert_state_dict_mha_to_normal_attn
+from text_util import text_cache, chunk_tokens, encode_padding_chunk, apply_caption_dropout, TextEmbeddingStore, ConditioningProducer, max_token_chunks
+from attention_util import set_attention_memory_budget, warm_up_attention_backends
+from compile_util import compile_stage_c, bucket_latent_shapes, print_report
+from checkpoint_util import tune_checkpointing, print_tuning_report, enable_activation_offload
+from cache_util import LatentCacheReader, LatentCacheWriter, LatentCacheBuilder
+from service_util import EncoderClient
 from optim_util import step_adafactor
 from bucketeer import Bucketeer
 from warmup_scheduler import GradualWarmupScheduler
@@ -57,61 +60,11 @@ def load_model(model, model_id=None, full_path=None, strict=True, settings=None)
 
 	ckpt = load_or_fail(full_path, wandb_run_id=None)
 	if ckpt is not None:
-
-		if settings["flash_attention"]:
-			ckpt = convert_state_dict_mha_to_normal_attn(ckpt)
-
 		model.load_state_dict(ckpt, strict=strict)
 		del ckpt
 	return model
 
 
-def text_cache(dropout, text_model, accelerator, captions, att_mask, tokenizer, settings, batch_size):
-	text_embeddings = None
-	text_embeddings_pool = None
-
-	# Token concatenation things:
-	max_length = tokenizer.model_max_length
-	max_standard_tokens = max_length - 2
-	token_chunks_limit = math.ceil(settings["max_token_limit"] / max_standard_tokens)
-
-	if token_chunks_limit < 1:
-		token_chunks_limit = 1
-
-	if dropout:
-		captions_unpooled = ["" for _ in range(batch_size)]
-		clip_tokens_unpooled = tokenizer(captions_unpooled, truncation=True, padding="max_length",
-										max_length=tokenizer.model_max_length,
-										return_tensors="pt").to(accelerator.device)
-
-		text_encoder_output = text_model(**clip_tokens_unpooled, output_hidden_states=True)
-		text_embeddings = text_encoder_output.hidden_states[settings["clip_skip"]]
-		text_embeddings_pool = text_encoder_output.text_embeds.unsqueeze(1)
-	else:
-		for chunk_id in range(len(captions)):
-			# Hard limit the tokens to fit in memory for the rare event that latent caches that somehow exceed the limit.
-			if chunk_id > (token_chunks_limit):
-				break
-
-			token_chunk = captions[chunk_id].to(accelerator.device)
-			token_chunk = torch.cat((torch.full((token_chunk.shape[0], 1), tokenizer.bos_token_id).to(accelerator.device), token_chunk, torch.full((token_chunk.shape[0], 1), tokenizer.eos_token_id).to(accelerator.device)), 1)
-			attn_chunk = att_mask[chunk_id].to(accelerator.device)
-			# First 75 tokens we allow BOS to not be masked - otherwise we mask them out
-			if chunk_id == 0:
-				attn_chunk = torch.cat((torch.full((attn_chunk.shape[0], 1), 1).to(accelerator.device), attn_chunk, torch.full((attn_chunk.shape[0], 1), 0).to(accelerator.device)), 1)
-			else:
-				attn_chunk = torch.cat((torch.full((attn_chunk.shape[0], 1), 0).to(accelerator.device), attn_chunk, torch.full((attn_chunk.shape[0], 1), 0).to(accelerator.device)), 1)
-			text_encoder_output = text_model(**{"input_ids": token_chunk, "attention_mask": attn_chunk}, output_hidden_states=True)
-
-			if text_embeddings is None:
-				text_embeddings = text_encoder_output["hidden_states"][settings["clip_skip"]]
-				text_embeddings_pool = text_encoder_output.text_embeds.unsqueeze(1)
-			else:
-				text_embeddings = torch.cat((text_embeddings, text_encoder_output["hidden_states"][settings["clip_skip"]]), dim=-2)
-				text_embeddings_pool = torch.cat((text_embeddings_pool, text_encoder_output.text_embeds.unsqueeze(1)), dim=-2)
-
-	return text_embeddings, text_embeddings_pool
-
 # Replaced WarpCore with a more simplified version of it
 # made compatible with HF Accelerate
 def main():
@@ -136,6 +89,31 @@ def main():
 	settings["multi_aspect_ratio"] = [1/1, 1/2, 1/3, 2/3, 3/4, 1/5, 2/5, 3/5, 4/5, 1/6, 5/6, 9/16]
 	settings["model_name"] = "untitled_model"
 	settings["adaptive_loss_weight"] = False
+	settings["dropout"] = 0.1
+	settings["latent_cache_readahead"] = 4
+	settings["latent_cache_workers"] = 2
+	settings["memoize_latents"] = False
+	settings["latent_cache_batch_size"] = None
+	settings["latent_cache_max_batch_size"] = 64
+	settings["group_by_token_length"] = False
+	settings["token_length_randomness"] = 2.0
+	settings["text_encode_ahead"] = 0
+	settings["encoder_service"] = None
+	settings["encoder_service_authkey"] = None
+	settings["diffusion_samples_per_latent"] = 1
+	settings["channels_last"] = False
+	settings["compile"] = False
+	settings["attention_backend"] = "mha"
+	settings["attention_memory_budget"] = 256
+	settings["token_merging_ratios"] = None
+	settings["token_merging_training"] = False
+	settings["checkpoint_block_types"] = ["ResBlock", "AttnBlock"]
+	settings["checkpoint_levels"] = None
+	settings["checkpoint_every"] = 1
+	settings["checkpoint_memory_budget"] = None
+	settings["activation_offload_levels"] = None
+	settings["activation_offload_prefetch"] = 2
+	settings["compile_cache_dir"] = "output/compile_cache"
 
 	gdf = GDF(
 		schedule=CosineSchedule(clamp_range=[0.0001, 0.9999]),
@@ -175,6 +153,8 @@ def main():
 	else:
 		raise ValueError("No configuration supplied, stopping.")
 
+	set_attention_memory_budget(settings["attention_memory_budget"] * 1024 ** 2)
+
 	if settings["use_pytorch_cross_attention"]:
 		print("Activating efficient cross attentions.")
 		torch.backends.cuda.enable_math_sdp(True)
@@ -216,28 +196,51 @@ def main():
 		project_dir=f"{settings['output_path']}"
 	)
 
-	# Model Loading For Latent Caching
-	# EfficientNet
-	print("Loading EfficientNetEncoder")
-	effnet = EfficientNetEncoder()
-	effnet_checkpoint = load_or_fail(settings["effnet_checkpoint_path"])
-	effnet.load_state_dict(effnet_checkpoint if "state_dict" not in effnet_checkpoint else effnet_checkpoint["state_dict"])
-	effnet.eval().requires_grad_(False).to(accelerator.device, dtype=torch.bfloat16)
-	del effnet_checkpoint
+	# Model Loading
+	# Models are built the first time they're used, so encoders a run never touches are never loaded
+	registry = ModelRegistry()
+
+	def load_effnet():
+		print("Loading EfficientNetEncoder")
+		effnet = EfficientNetEncoder()
+		effnet_checkpoint = load_or_fail(settings["effnet_checkpoint_path"])
+		effnet.load_state_dict(effnet_checkpoint if "state_dict" not in effnet_checkpoint else effnet_checkpoint["state_dict"])
+		effnet.eval().requires_grad_(False).to(accelerator.device, dtype=torch.bfloat16)
+		return effnet
+
+	def load_text_model():
+		print("Loading CLIP Text Encoder")
+		text_model = CLIPTextModelWithProjection.from_pretrained(settings["clip_text_model_name"]).requires_grad_(False).to(accelerator.device, dtype=main_dtype)
+		return text_model.eval()
+
+	def load_image_model():
+		print("Loading CLIP Image Encoder")
+		image_model = CLIPVisionModelWithProjection.from_pretrained(settings["clip_image_model_name"]).requires_grad_(False).to(accelerator.device, dtype=main_dtype)
+		return image_model.eval()
+
+	registry.register("effnet", load_effnet)
+	registry.register("text_model", load_text_model)
+	registry.register("image_model", load_image_model)
+	registry.register("tokenizer", lambda: AutoTokenizer.from_pretrained(settings["clip_text_model_name"]))
 
 	# CLIP Encoders
-	print("Loading CLIP Text Encoder")
-	text_model = CLIPTextModelWithProjection.from_pretrained(settings["clip_text_model_name"]).requires_grad_(False).to(accelerator.device, dtype=main_dtype)
-	text_model.eval()
-	print("Loading CLIP Image Encoder")
-	image_model = CLIPVisionModelWithProjection.from_pretrained(settings["clip_image_model_name"]).requires_grad_(False).to(accelerator.device, dtype=main_dtype)
-	image_model.eval()
+	# With an encoder service every process on the node shares one copy of them
+	encoder_client = None
+	if settings["encoder_service"] is not None:
+		print(f"Connecting to the encoder service at {settings['encoder_service']}")
+		authkey = settings["encoder_service_authkey"]
+		encoder_client = EncoderClient(settings["encoder_service"], device=accelerator.device, authkey=authkey.encode() if authkey is not None else None)
+
+	def encode_clip_image(images):
+		if encoder_client is not None:
+			return encoder_client.encode_image(clip_preprocess(images))
+		return registry["image_model"](clip_preprocess(images)).image_embeds
 
 	pre_dataset = []
 	# Create second dataset so all images are batched if we're either caching latents or 
 	dataset = []
 
-	tokenizer = AutoTokenizer.from_pretrained(settings["clip_text_model_name"])
+	tokenizer = registry["tokenizer"]
 	# Setup Dataloader:
 	# Only load from the dataloader when not latent caching
 	if not settings["use_latent_cache"]:
@@ -258,7 +261,11 @@ def main():
 
 		print("Buckets")
 
-		pre_dataset.bucketize(settings["batch_size"])
+		pre_dataset.bucketize(
+			settings["batch_size"],
+			group_by_tokens=settings["group_by_token_length"],
+			token_randomness=settings["token_length_randomness"]
+		)
 		print(f"Total Invalid Files:  {pre_dataset.get_rejects()}")
 		settings["multi_aspect_ratio"] = pre_dataset.get_buckets()
 
@@ -269,36 +276,9 @@ def main():
 		raw_tokens = [data["tokens"] for data in batch]
 		aspects = [data["aspects"] for data in batch]
 		
-		# Get total number of chunks
-		max_len = max(len(x) for x in raw_tokens)
-		num_chunks = math.ceil(max_len / (tokenizer.model_max_length - 2))
-		if num_chunks < 1:
-			num_chunks = 1
-		
-		# Get the true padded length of the tokens
-		len_input = tokenizer.model_max_length - 2
-		if num_chunks > 1:
-			len_input = (tokenizer.model_max_length * num_chunks) - (num_chunks * 2)
-		
-		# Tokenize!
-		tokens = tokenizer.pad(
-			{"input_ids": raw_tokens},
-			padding="max_length",
-			max_length=len_input,
-			return_tensors="pt"
-		).to(accelerator.device)
-		batch_tokens = tokens["input_ids"].to(accelerator.device)
-		batch_att_mask = tokens["attention_mask"].to(accelerator.device)
-
-		max_standard_tokens = tokenizer.model_max_length - 2
-		true_len = max(len(x) for x in batch_tokens)
-		n_chunks = np.ceil(true_len / max_standard_tokens).astype(int)
-		max_len = n_chunks.item() * max_standard_tokens
-
-		cropped_tokens = [batch_tokens[:, i:i + max_standard_tokens] for i in range(0, max_len, max_standard_tokens)]
-		cropped_attn = [batch_att_mask[:, i:i + max_standard_tokens] for i in range(0, max_len, max_standard_tokens)]
-		
-		return {"images": images, "tokens": cropped_tokens, "att_mask": cropped_attn, "caption": caption, "aspects": aspects, "dropout": False}
+		cropped_tokens, cropped_attn = chunk_tokens(raw_tokens, tokenizer, accelerator.device)
+
+		return {"images": images, "tokens": cropped_tokens, "att_mask": cropped_attn, "raw_tokens": raw_tokens, "caption": caption, "aspects": aspects}
 
 	pre_dataloader = DataLoader(
 		pre_dataset, batch_size=settings["batch_size"], shuffle=False, collate_fn=pre_collate, pin_memory=False,
@@ -317,35 +297,25 @@ def main():
 		transforms=torchvision.transforms.ToTensor(),
 	)
 
-	# Add duplicate dropout batches with a sufficient amount of steps only when not creating or using a latent cache
-	if settings["dropout"] > 0 and not (settings["use_latent_cache"] or settings["create_latent_cache"]):
-		dataset_len = len(dataset)
-		if dataset_len > 100 and not settings["create_latent_cache"]:
-			dropouts = random.sample(dataset, int(dataset_len * settings["dropout"]))
-			new_dropouts = copy.deepcopy(dropouts)
-			for batch in new_dropouts:
-				batch["dropout"] = True
-			dataset.extend(new_dropouts)
-			print(f"Duplicated {len(dropouts)} batches for caption dropout.")
-			print(f"Updated Step Count: {len(dataset)}")
-		else:
-			print("Could not create duplicate batches for caption dropout due to insufficient batch counts.")
-
-	def collate(batch):
+	def load_images(batch):
 		images = []
 		# The reason for not unrolling the images in the prior dataloader was so we can load them only when training,
 		# rather than storing all transformed images in memory!
-		aspects = batch[0]["aspects"]
-		img = batch[0]["images"]
-		for i in range(0, len(batch[0]["images"])):
+		aspects = batch["aspects"]
+		img = batch["images"]
+		for i in range(0, len(batch["images"])):
 			images.append(auto_bucketer.load_and_resize(img[i], float(aspects[i])))
 		images = torch.stack(images)
-		images = images.to(memory_format=torch.contiguous_format)
+		return images.to(memory_format=torch.contiguous_format)
+
+	def collate(batch):
+		images = load_images(batch[0])
 		images = images.to(accelerator.device)
 		tokens = batch[0]["tokens"]
 		att_mask = batch[0]["att_mask"]
+		raw_tokens = batch[0]["raw_tokens"]
 		captions = batch[0]["caption"]
-		return {"images": images, "tokens": tokens, "att_mask": att_mask, "captions": captions, "dropout": False}
+		return {"images": images, "tokens": tokens, "att_mask": att_mask, "raw_tokens": raw_tokens, "captions": captions}
 
 	# Shuffle the dataset and initialise the dataloader if we're not latent caching
 	set_seed(settings["seed"])
@@ -356,29 +326,61 @@ def main():
 	)
 
 	# Optional Latent Caching Step:
-	te_dropout, pool_dropout = text_cache(True, text_model, accelerator, [], [], tokenizer, settings, settings["batch_size"])
-	def latent_collate(batch):
-		cache = torch.load(batch[0]["path"])
-		if "dropout" in batch:
-			cache[0]["dropout"] = True
-		return cache
+	# Memoization trains the first epoch from images and writes a latent cache along the way
+	memoize_latents = settings["memoize_latents"] and settings["num_epochs"] > 1 and not (settings["create_latent_cache"] or settings["use_latent_cache"])
+
+	def encode_text(tokens, att_mask, batch_size, dropout=False):
+		if encoder_client is not None:
+			return encoder_client.encode_text(tokens, att_mask, batch_size, dropout=dropout)
+		return text_cache(dropout, registry["text_model"], accelerator, tokens, att_mask, tokenizer, settings, batch_size)
+
+	# Text encoder outputs are shared by every latent cache entry with the same tokens
+	text_store = None
+	if settings["cache_text_encoder"] and (settings["create_latent_cache"] or settings["use_latent_cache"] or memoize_latents):
+		text_store = TextEmbeddingStore(
+			settings["text_cache_location"] if "text_cache_location" in settings else os.path.join(settings["latent_cache_location"], "text_embeddings"),
+			tokenizer,
+			settings["clip_text_model_name"],
+			clip_skip=settings["clip_skip"],
+			encode_fn=encode_text
+		)
+
+	# Caption dropout swaps single samples for the empty prompt, which is only encoded once.
+	# Resolve the padding chunk up front too, the text model may be gone by the time a batch needs it
+	with torch.no_grad():
+		te_dropout, pool_dropout = text_store.get_dropout() if text_store is not None else encode_text([], [], 1, dropout=True)
+		te_padding = text_store.get_padding() if text_store is not None else encode_padding_chunk(encode_text, tokenizer)
 
 	latent_cache = []
 	# Create a latent cache if we're not going to load an existing one.
 	if settings["create_latent_cache"] and not settings["use_latent_cache"]:
-		create_folder_if_necessary(settings["latent_cache_location"])
-		step = 0
-		for batch in tqdm(dataloader, desc="Latent Caching"):
-			batch["effnet_cache"] = effnet(effnet_preprocess(batch["images"].to(dtype=main_dtype)))
-			batch["clip_cache"] = image_model(clip_preprocess(batch["images"])).image_embeds
-			if settings["cache_text_encoder"]:
-				te_cache, pool_cache = text_cache(False, text_model, accelerator, batch["tokens"], batch["att_mask"], tokenizer, settings, settings["batch_size"])
-				batch["text_cache"] = te_cache
-				batch["pool_cache"] = pool_cache
-			del batch["images"]
-			torch.save(batch, os.path.join(settings["latent_cache_location"], f"latent_cache_{step}.pt"))
-			latent_cache.append({"path": os.path.join(settings["latent_cache_location"], f"latent_cache_{step}.pt")})
-			step += 1
+		registry["effnet"].to(memory_format=torch.channels_last)
+
+		def encode_images(images):
+			images = images.to(accelerator.device, memory_format=torch.channels_last)
+			return {
+				"effnet_cache": registry["effnet"](effnet_preprocess(images.to(dtype=main_dtype))),
+				"clip_cache": encode_clip_image(images)
+			}
+
+		# The cache builder batches images independently of the training batch size
+		cache_builder = LatentCacheBuilder(
+			load_images, encode_images,
+			LatentCacheWriter(settings["latent_cache_location"]),
+			encode_batch_size=settings["latent_cache_batch_size"],
+			max_encode_batch_size=settings["latent_cache_max_batch_size"],
+			text_store=text_store
+		)
+		latent_cache = cache_builder.build([{
+			"images": batch["images"],
+			"aspects": batch["aspects"],
+			"tokens": batch["tokens"],
+			"att_mask": batch["att_mask"],
+			"raw_tokens": batch["raw_tokens"],
+			"captions": batch["caption"]
+		} for batch in dataset])
+		if text_store is not None:
+			print(f"Encoded {text_store.misses} unique captions for {text_store.misses + text_store.hits} samples.")
 	
 	elif settings["use_latent_cache"]:
 		# Load all latent caches from disk. Note that batch size is ignored here and can theoretically be mixed.
@@ -390,23 +392,17 @@ def main():
 		
 		print("Loading media from the Latent Cache.")
 		for cache in os.listdir(settings["latent_cache_location"]):
-			latent_cache.append({"path": os.path.join(settings["latent_cache_location"], cache)})
+			cache_path = os.path.join(settings["latent_cache_location"], cache)
+			if os.path.isfile(cache_path) and cache.endswith(".pt"):
+				latent_cache.append({"path": cache_path})
 
 	if settings["create_latent_cache"] or settings["use_latent_cache"]:
-		# Handle duplicates for Latent Caching
-		if settings["dropout"] > 0:
-			if len(latent_cache) > 100:
-				dropouts = random.sample(latent_cache, int(len(latent_cache) * settings["dropout"]))
-				new_dropouts = copy.deepcopy(dropouts)
-				for batch in new_dropouts:
-					batch["dropout"] = True
-				latent_cache.extend(new_dropouts)
-				print(f"Duplicated {len(new_dropouts)} caches for caption dropout.")
-				print(f"Total Cached Step Count: {len(latent_cache)}")
-		
 		random.shuffle(latent_cache)
-		dataloader = DataLoader(
-			latent_cache, batch_size=1, collate_fn=latent_collate, shuffle=False, pin_memory=False
+		dataloader = LatentCacheReader(
+			latent_cache, accelerator.device,
+			readahead=settings["latent_cache_readahead"],
+			num_workers=settings["latent_cache_workers"],
+			text_store=text_store
 		)
 
 	# Special things
@@ -421,15 +417,16 @@ def main():
 			raise ValueError('model_version key is missing from supplied YAML.')
 		
 		flash_attention = settings["flash_attention"]
+		attention_backend = settings["attention_backend"]
 		generator_ema = None
 		if settings["model_version"] == "3.6B":
-			generator = StageC(flash_attention=flash_attention)
+			generator = StageC(flash_attention=flash_attention, attention_backend=attention_backend)
 			if "ema_start_iters" in settings:
-				generator_ema = StageC(flash_attention=flash_attention)
+				generator_ema = StageC(flash_attention=flash_attention, attention_backend=attention_backend)
 		elif settings["model_version"] == "1B":
-			generator = StageC(c_cond=1536, c_hidden=[1536, 1536], nhead=[24, 24], blocks=[[4, 12], [12, 4]], flash_attention=flash_attention)
+			generator = StageC(c_cond=1536, c_hidden=[1536, 1536], nhead=[24, 24], blocks=[[4, 12], [12, 4]], flash_attention=flash_attention, attention_backend=attention_backend)
 			if "ema_start_iters" in settings:
-				generator_ema = StageC(c_cond=1536, c_hidden=[1536, 1536], nhead=[24, 24], blocks=[[4, 12], [12, 4]], flash_attention=flash_attention)
+				generator_ema = StageC(c_cond=1536, c_hidden=[1536, 1536], nhead=[24, 24], blocks=[[4, 12], [12, 4]], flash_attention=flash_attention, attention_backend=attention_backend)
 		else:
 			raise ValueError(f"Unknown model size: {settings['model_version']}, stopping.")
 
@@ -441,13 +438,67 @@ def main():
 		# return
 	else:
 		generator = load_model(generator, model_id='generator', settings=settings)
-	enable_checkpointing_for_stable_cascade_blocks(generator,accelerator.device)
 	generator = generator.to(accelerator.device, dtype=main_dtype)
+	if settings["channels_last"]:
+		generator.set_channels_last()
+	if settings["token_merging_ratios"] is not None:
+		generator.set_token_merging(settings["token_merging_ratios"], training=settings["token_merging_training"])
+	if attention_backend == "auto" and not flash_attention:
+		# Benchmarks the backends once per bucket and chunk count, before any checkpoint or offload hooks are in place
+		print("Choosing attention backends for every bucket shape.")
+		generator.train()
+		with torch.autocast(accelerator.device.type, dtype=torch.bfloat16):
+			attention_choices = warm_up_attention_backends(generator, (
+				stage_c_inputs(generator, settings["batch_size"] * settings["diffusion_samples_per_latent"], shape, n_chunks, device=accelerator.device, dtype=torch.bfloat16)
+				for shape in bucket_latent_shapes(auto_bucketer)
+				for n_chunks in range(1, max_token_chunks(settings["max_token_limit"]) + 1)
+			))
+		if accelerator.is_main_process:
+			print(f"Attention backends: {sorted(set(attention_choices.values()))} over {len(attention_choices)} shapes")
+
+	if settings["checkpoint_memory_budget"] is not None:
+		print("Tuning activation checkpointing for the largest bucket.")
+		checkpoint_policy, checkpoint_report = tune_checkpointing(
+			generator, bucket_latent_shapes(auto_bucketer), settings["checkpoint_memory_budget"] * 1024 ** 3,
+			batch_size=settings["batch_size"] * settings["diffusion_samples_per_latent"],
+			n_chunks=max_token_chunks(settings["max_token_limit"]),
+			device=accelerator.device, dtype=torch.bfloat16, autocast_dtype=torch.bfloat16
+		)
+		if accelerator.is_main_process:
+			print_tuning_report(checkpoint_report)
+			print(f"Checkpointing with {checkpoint_policy}")
+	else:
+		checkpoint_policy = CheckpointPolicy(settings["checkpoint_block_types"], levels=settings["checkpoint_levels"], every=settings["checkpoint_every"])
+		enable_checkpointing_for_stable_cascade_blocks(generator, accelerator.device, checkpoint_policy)
+	activation_offloader = None
+	if settings["activation_offload_levels"] is not None:
+		activation_offloader = enable_activation_offload(generator, settings["activation_offload_levels"], accelerator.device, prefetch=settings["activation_offload_prefetch"])
+
+	# The compiled module is only used for the forward, the original keeps the state dict keys for saving
+	generator_forward = generator
+	if settings["compile"]:
+		print("Compiling Stage C for every bucket shape.")
+		generator_forward, compile_report = compile_stage_c(
+			generator, bucket_latent_shapes(auto_bucketer),
+			chunk_counts=[1, 2] if settings["max_token_limit"] > 75 else [1],
+			batch_size=settings["batch_size"] * settings["diffusion_samples_per_latent"],
+			device=accelerator.device, dtype=torch.bfloat16, autocast_dtype=torch.bfloat16,
+			training=True, cache_dir=settings["compile_cache_dir"]
+		)
+		if accelerator.is_main_process:
+			print_report(compile_report)
+		# The warmup steps ran through the offload hooks, the first real step starts a new order
+		if activation_offloader is not None:
+			activation_offloader.reset()
 
 	if generator_ema is not None:
 		generator_ema.load_state_dict(generator.state_dict())
 		generator_ema = load_model(generator_ema, "generator_ema", settings=settings)
 		generator_ema.to(accelerator.device, dtype=main_dtype)
+		if settings["channels_last"]:
+			generator_ema.set_channels_last()
+		if settings["token_merging_ratios"] is not None:
+			generator_ema.set_token_merging(settings["token_merging_ratios"])
 
 	# Load optimizers
 	optimizer_type = settings["optimizer_type"].lower()
@@ -482,66 +533,108 @@ def main():
 	scheduler = GradualWarmupScheduler(optimizer, multiplier=1, total_epoch=settings["warmup_updates"])
 	scheduler.last_epoch = info["total_steps"] if "total_steps" in info else len(dataloader)
 
-	accelerator.prepare(generator, dataloader, text_model, image_model, optimizer, scheduler)
+	accelerator.prepare(generator, dataloader, optimizer, scheduler)
 
 	if accelerator.is_main_process:
 		accelerator.init_trackers("training")
 
-	# Training loop
-	steps_bar = tqdm(dataloader, desc="Steps to Epoch")
-	epoch_bar = tqdm(range(settings["num_epochs"]), desc="Epochs")
-	generator.train()
-	total_steps = 0
-
 	# Special case for handling latent caching
 	# saves one second of time to avoid expensive key checking
 	# We enable this if we've just finished latent caching and want to immediately start training thereafter
 	is_latent_cache = False
 	if settings["use_latent_cache"] or settings["create_latent_cache"]:
 		is_latent_cache = True
-		del image_model
+		registry.release("image_model", "effnet")
 		if settings["cache_text_encoder"]:
-			del text_model
-		del effnet
-		torch.cuda.empty_cache()
+			registry.release("text_model")
+
+	memo_writer = LatentCacheWriter(settings["latent_cache_location"], exclude=["images", "text_embeddings", "text_embeddings_pool"]) if memoize_latents else None
+
+	def encode_batch_text(batch):
+		if memo_writer is not None and text_store is not None:
+			batch["text_keys"] = text_store.encode(batch["raw_tokens"])
+			return text_store.load(batch["text_keys"], accelerator.device)
+		return encode_text(batch["tokens"], batch["att_mask"], len(batch["captions"]))
+
+	def with_conditioning(loader):
+		# Encode text for the next batches while the generator trains, unless it's already cached
+		if settings["text_encode_ahead"] > 0 and not (is_latent_cache and text_store is not None):
+			return ConditioningProducer(loader, encode_batch_text, accelerator.device, ahead=settings["text_encode_ahead"])
+		return loader
+
+	# Training loop
+	steps_bar = tqdm(with_conditioning(dataloader), desc="Steps to Epoch")
+	epoch_bar = tqdm(range(settings["num_epochs"]), desc="Epochs")
+	generator.train()
+	total_steps = 0
 
 	with accelerator.accumulate(generator):
 		for e in epoch_bar:
 			current_step = 0
+
+			# Everything the encoders produced in the first epoch is on disk, train from it from here on
+			if memo_writer is not None and e > 0:
+				latent_cache = memo_writer.close()
+				memo_writer = None
+				random.shuffle(latent_cache)
+				dataloader = LatentCacheReader(
+					latent_cache, accelerator.device,
+					readahead=settings["latent_cache_readahead"],
+					num_workers=settings["latent_cache_workers"],
+					text_store=text_store
+				)
+				print(f"Memoized {len(latent_cache)} latent caches, releasing the image encoders.")
+				is_latent_cache = True
+				steps_bar = tqdm(with_conditioning(dataloader), desc="Steps to Epoch")
+				registry.release("image_model", "effnet")
+				if settings["cache_text_encoder"]:
+					registry.release("text_model")
+
 			for batch in steps_bar:
 				captions = batch["tokens"]
 				attn_mask = batch["att_mask"]
 				images = batch["images"] if not is_latent_cache else None
-				dropout = batch["dropout"]
 				batch_size = len(batch["captions"])
+				dropout = torch.rand(batch_size) < settings["dropout"]
 				
 				with torch.no_grad():
 					text_embeddings = None
 					text_embeddings_pool = None
-					if is_latent_cache:
-						if dropout:
-							text_embeddings = te_dropout
-							text_embeddings_pool = pool_dropout
-						elif "text_cache" in batch and "pool_cache" in batch:
-							text_embeddings = batch["text_cache"]
-							text_embeddings_pool = batch["pool_cache"]
-						else:
-							text_embeddings, text_embeddings_pool = text_cache(dropout, text_model, accelerator, captions, attn_mask, tokenizer, settings, batch_size)
+					if "text_embeddings" in batch and "text_embeddings_pool" in batch:
+						text_embeddings = batch["text_embeddings"]
+						text_embeddings_pool = batch["text_embeddings_pool"]
+					elif is_latent_cache and "text_cache" in batch and "pool_cache" in batch:
+						text_embeddings = batch["text_cache"]
+						text_embeddings_pool = batch["pool_cache"]
 					else:
-						text_embeddings, text_embeddings_pool = text_cache(dropout, text_model, accelerator, captions, attn_mask, tokenizer, settings, batch_size)
-					
-					
+						text_embeddings, text_embeddings_pool = encode_batch_text(batch)
+					text_embeddings, text_embeddings_pool = apply_caption_dropout(text_embeddings, text_embeddings_pool, dropout, te_dropout, pool_dropout, te_padding)
+
+					# The memo needs image embeddings of the whole batch, not just the ones picked this step
+					if memo_writer is not None:
+						batch["clip_cache"] = encode_clip_image(images)
+
 					# Handle Image Encoding
 					image_embeddings = torch.zeros(batch_size, 768, device=accelerator.device, dtype=main_dtype)
-					if not dropout:
-						rand_id = np.random.rand(batch_size) > 0.9
-						if any(rand_id):
-							image_embeddings[rand_id] = image_model(clip_preprocess(images[rand_id])).image_embeds if not is_latent_cache else batch["clip_cache"][rand_id]
+					rand_id = (np.random.rand(batch_size) > 0.9) & ~dropout.numpy()
+					if any(rand_id):
+						image_embeddings[rand_id] = encode_clip_image(images[rand_id]) if "clip_cache" not in batch else batch["clip_cache"][rand_id]
 					image_embeddings = image_embeddings.unsqueeze(1)
 
 					# Get Latents
-					latents = effnet(effnet_preprocess(images.to(dtype=main_dtype))) if not is_latent_cache else batch["effnet_cache"]
+					latents = registry["effnet"](effnet_preprocess(images.to(dtype=main_dtype))) if not is_latent_cache else batch["effnet_cache"]
+					if memo_writer is not None:
+						batch["effnet_cache"] = latents
+						memo_writer.write(batch)
 					latents = latents.to(dtype=main_dtype)
+
+					# Diffuse every encoded latent at several independent noise levels, the generator batch grows by the same factor
+					samples_per_latent = settings["diffusion_samples_per_latent"]
+					if samples_per_latent > 1:
+						latents = latents.repeat_interleave(samples_per_latent, dim=0)
+						text_embeddings = text_embeddings.repeat_interleave(samples_per_latent, dim=0)
+						text_embeddings_pool = text_embeddings_pool.repeat_interleave(samples_per_latent, dim=0)
+						image_embeddings = image_embeddings.repeat_interleave(samples_per_latent, dim=0)
 					noised, noise, target, logSNR, noise_cond, loss_weight = gdf.diffuse(latents.to(dtype=torch.bfloat16), shift=1, loss_shift=1)
 				
 				# Forwards Pass
@@ -549,7 +642,7 @@ def main():
 				#loss = None
 				#loss_adjusted = None
 				with torch.cuda.amp.autocast(dtype=torch.bfloat16):
-					pred = generator(noised, noise_cond, 
+					pred = generator_forward(noised, noise_cond, 
 						**{
 							"clip_text": text_embeddings.to(dtype=torch.bfloat16),
 							"clip_text_pooled": text_embeddings_pool.to(dtype=torch.bfloat16),
@@ -564,6 +657,8 @@ def main():
 
 				# Backwards Pass
 				accelerator.backward(loss_adjusted.to(dtype=torch.float32))
+				if activation_offloader is not None:
+					activation_offloader.reset()
 				grad_norm = nn.utils.clip_grad_norm_(generator.parameters(), 1.0)
 				optimizer.step()
 				scheduler.step()
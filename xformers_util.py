@@ -13,69 +13,56 @@ Licensed under the Apache License, Version 2.0 (the "License"); you may not use
 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
 """
 
-def convert_state_dict_mha_to_normal_attn(state_dict):
-    # convert nn.MultiheadAttention to to_q/k/v and out_proj
-    for key in list(state_dict.keys()):
-        if "attention.attn." in key:
-            if "in_proj_bias" in key:
-                value = state_dict.pop(key)
-                qkv = torch.chunk(value, 3, dim=0)
-                state_dict[key.replace("in_proj_bias", "to_q.bias")] = qkv[0]
-                state_dict[key.replace("in_proj_bias", "to_k.bias")] = qkv[1]
-                state_dict[key.replace("in_proj_bias", "to_v.bias")] = qkv[2]
-            elif "in_proj_weight" in key:
-                value = state_dict.pop(key)
-                qkv = torch.chunk(value, 3, dim=0)
-                state_dict[key.replace("in_proj_weight", "to_q.weight")] = qkv[0]
-                state_dict[key.replace("in_proj_weight", "to_k.weight")] = qkv[1]
-                state_dict[key.replace("in_proj_weight", "to_v.weight")] = qkv[2]
-            elif "out_proj.bias" in key:
-                value = state_dict.pop(key)
-                state_dict[key.replace("out_proj.bias", "out_proj.bias")] = value
-            elif "out_proj.weight" in key:
-                value = state_dict.pop(key)
-                state_dict[key.replace("out_proj.weight", "out_proj.weight")] = value
-    return state_dict
-
-
-def convert_state_dict_normal_attn_to_mha(state_dict):
-    # convert to_q/k/v and out_proj to nn.MultiheadAttention
-    for key in list(state_dict.keys()):
-        if "attention.attn." in key:
-            if "to_q.bias" in key:
-                q = state_dict.pop(key)
-                k = state_dict.pop(key.replace("to_q.bias", "to_k.bias"))
-                v = state_dict.pop(key.replace("to_q.bias", "to_v.bias"))
-                state_dict[key.replace("to_q.bias", "in_proj_bias")] = torch.cat([q, k, v])
-            elif "to_q.weight" in key:
-                q = state_dict.pop(key)
-                k = state_dict.pop(key.replace("to_q.weight", "to_k.weight"))
-                v = state_dict.pop(key.replace("to_q.weight", "to_v.weight"))
-                state_dict[key.replace("to_q.weight", "in_proj_weight")] = torch.cat([q, k, v])
-            elif "out_proj.bias" in key:
-                v = state_dict.pop(key)
-                state_dict[key.replace("out_proj.bias", "out_proj.bias")] = v
-            elif "out_proj.weight" in key:
-                v = state_dict.pop(key)
-                state_dict[key.replace("out_proj.weight", "out_proj.weight")] = v
-    return state_dict
-
 class Attention(nn.Module):
     def __init__(self, c, nhead, dropout=0.0):
         super().__init__()
 
-        self.to_q = Linear(c, c, bias=True)
-        self.to_k = Linear(c, c, bias=True)
-        self.to_v = Linear(c, c, bias=True)
+        # Same parameters as nn.MultiheadAttention, so MHA checkpoints load as is. q and kv are views of in_proj
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * c, c))
+        self.in_proj_bias = nn.Parameter(torch.zeros(3 * c))
+        nn.init.xavier_uniform_(self.in_proj_weight)
         self.out_proj = Linear(c, c, bias=True)
+        self.c = c
         self.nhead = nhead
         self.dropout = dropout
         self.scale = (c // nhead) ** -0.5
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved with the separate to_q/to_k/to_v layout
+        if prefix + "to_q.weight" in state_dict:
+            for name in ["weight", "bias"]:
+                qkv = [state_dict.pop(f"{prefix}to_{p}.{name}") for p in "qkv"]
+                state_dict[f"{prefix}in_proj_{name}"] = torch.cat(qkv)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def to_q(self, x):
+        return nn.functional.linear(x, self.in_proj_weight[:self.c], self.in_proj_bias[:self.c])
+
+    def to_kv(self, x):
+        # Keys and values of the same tokens in one GEMM
+        return nn.functional.linear(x, self.in_proj_weight[self.c:], self.in_proj_bias[self.c:]).chunk(2, dim=-1)
+
     def forward(self, q_in, k_in, v_in):
+        # k_in and v_in are always the same tokens
         q_in = self.to_q(q_in)
-        k_in = self.to_k(k_in)
-        v_in = self.to_v(v_in)
+        k_in, v_in = self.to_kv(k_in)
+
+        q, k, v = map(lambda t: rearrange(t, "b n (h d) -> b n h d", h=self.nhead), (q_in, k_in, v_in))
+        del q_in, k_in, v_in
+        out = self.forward_memory_efficient_xformers(q, k, v)
+        del q, k, v
+        out = rearrange(out, "b n h d -> b n (h d)", h=self.nhead)
+
+        return self.out_proj(out)
+
+    def forward_cached(self, q_in, k_in, v_in, cond_k, cond_v):
+        # cond_k/cond_v are the already projected conditioning tokens appended after k_in/v_in
+        q_in = self.to_q(q_in)
+        if k_in is None:
+            k_in, v_in = cond_k, cond_v
+        else:
+            k_in, v_in = self.to_kv(k_in)
+            k_in, v_in = torch.cat([k_in, cond_k], dim=1), torch.cat([v_in, cond_v], dim=1)
 
         q, k, v = map(lambda t: rearrange(t, "b n (h d) -> b n h d", h=self.nhead), (q_in, k_in, v_in))
         del q_in, k_in, v_in
@@ -133,4 +120,15 @@ class FlashAttention2D(nn.Module):
         # x = self.attn(x, kv, kv, need_weights=False)[0]
         x = self.attn(x, kv, kv)
         x = x.permute(0, 2, 1).view(*orig_shape)
+        return x
+
+    def cond_kv(self, kv):
+        return self.attn.to_kv(kv)
+
+    def forward_cached(self, x, cond_k, cond_v, self_attn=False):
+        orig_shape = x.shape
+        x = x.view(x.size(0), x.size(1), -1).permute(0, 2, 1)  # Bx4xHxW -> Bx(HxW)x4
+        kv = x if self_attn else None
+        x = self.attn.forward_cached(x, kv, kv, cond_k, cond_v)
+        x = x.permute(0, 2, 1).view(*orig_shape)
         return x
\ No newline at end of file